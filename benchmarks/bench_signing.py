@@ -0,0 +1,134 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Micro-benchmark of response signing: the original per response signature,
+which walked the task config for every response, TaskIO.sign_response and the
+batch TaskIO.sign_responses.
+
+    python benchmarks/bench_signing.py
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import timeit
+
+from dynalab.tasks.task_io import TaskIO
+
+
+TASK_INFO = {
+    "task": "nli",
+    "config": {
+        "context": [{"name": "context", "type": "string"}],
+        "input": [
+            {"name": "hypothesis", "type": "string"},
+            {
+                "name": "label",
+                "type": "multiclass",
+                "labels": ["entailed", "neutral", "contradictory"],
+            },
+        ],
+        "output": [
+            {"name": "label"},
+            {"name": "prob", "type": "prob", "reference_name": "label"},
+        ],
+    },
+}
+
+
+def legacy_parse_signature_input(task_io, response, data):
+    # parse_signature_input before the TaskIO plan, walking the config each time
+    task = task_io.task_info["task"]
+
+    def add_annotations(annotations, container_obj, value_src):
+        for annotation in annotations:
+            name = annotation["name"]
+            if name in value_src:
+                container_obj[name] = value_src[name]
+
+    inputs, outputs = dict(), dict()
+    add_annotations(task_io.inputs_without_targets, inputs, data)
+    add_annotations(task_io.task_info["config"].get("context", []), inputs, data)
+    add_annotations(
+        TaskIO.get_full_output_annotation_config_objs(task_io.task_info["config"]),
+        outputs,
+        response,
+    )
+    return task, inputs, outputs
+
+
+def legacy_signature(task_io, response, data, secret=""):
+    task, inputs, outputs = legacy_parse_signature_input(task_io, response, data)
+    h = hashlib.sha1()
+    h.update(os.environ.get("MY_SECRET", secret).encode("utf-8"))
+    h.update(task.encode("utf-8"))
+    for key in sorted(inputs.keys()):
+        h.update(str(inputs[key]).encode("utf-8"))
+    for key in sorted(outputs.keys()):
+        h.update(str(outputs[key]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def main():
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(TASK_INFO, f)
+    task_io = TaskIO(TASK_INFO["task"], task_info_path=f.name)
+    os.remove(f.name)
+
+    print(
+        f"{'batch size':>10} {'legacy':>12} {'sign_response':>14} "
+        f"{'sign_responses':>15} {'speedup':>8}"
+    )
+    for batch_size in (1, 64, 4096):
+        data = [
+            {
+                "uid": str(i),
+                "context": "It is a good day " * (i % 20 + 1),
+                "hypothesis": "The day is good",
+            }
+            for i in range(batch_size)
+        ]
+        responses = [
+            {
+                "id": datum["uid"],
+                "label": "neutral",
+                "prob": {"entailed": 0.2, "neutral": 0.5, "contradictory": 0.3},
+            }
+            for datum in data
+        ]
+        task_io.sign_responses(responses, data)
+        assert all(
+            response["signature"] == legacy_signature(task_io, response, datum)
+            for response, datum in zip(responses, data)
+        ), "Signatures differ from the legacy ones"
+
+        number = max(20000 // batch_size, 1)
+
+        def run_legacy():
+            for response, datum in zip(responses, data):
+                response["signature"] = legacy_signature(task_io, response, datum)
+
+        def run_single():
+            for response, datum in zip(responses, data):
+                task_io.sign_response(response, datum)
+
+        timings = [
+            min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+            for func in (
+                run_legacy,
+                run_single,
+                lambda: task_io.sign_responses(responses, data),
+            )
+        ]
+        print(
+            f"{batch_size:>10} {timings[0]:>10.1f}us {timings[1]:>12.1f}us "
+            f"{timings[2]:>13.1f}us {timings[0] / timings[2]:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
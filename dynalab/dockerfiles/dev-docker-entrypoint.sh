@@ -16,26 +16,43 @@ set -m
 
 # start torchserve
 echo "Start serving model..."
+start_time=$(date +%s.%N)
 torchserve --start --ncs --models ${model_name}.mar --model-store /opt/ml/model 1>&2 &
 
-# health ping to make sure the http connection is on
+# health ping to make sure the http connection is on, polling with an
+# exponential backoff from 0.1s to 2s, until STARTUP_TIMEOUT seconds
 echo "Check model loading status..."
-status=$(curl -s http://localhost:8080/ping)
-while [[ $status != Healthy ]]; do
-    if [[ -z $status ]]; then
-        echo "HTTP connection has not yet been set up. Sleep 30..."
-        sleep 30
-        status=$(curl -s http://localhost:8080/ping)
-    else
-        status=$(python -c "import json; print($status['status'])")
-        if [[ $status = Unhealthy ]]; then
+startup_timeout=${STARTUP_TIMEOUT:-600}
+delay=0.1
+while true; do
+    status=$(curl -s --max-time 5 http://localhost:8080/ping)
+    if [[ -n $status ]]; then
+        status=$(python -c "import json, sys; print(json.loads(sys.argv[1])['status'])" "$status")
+        if [[ $status = Healthy ]]; then
+            break
+        elif [[ $status = Unhealthy ]]; then
             echo "Serving model failed."
             exit 1
         fi
     fi
+    elapsed=$(awk "BEGIN {print $(date +%s.%N) - $start_time}")
+    if awk "BEGIN {exit !($elapsed > $startup_timeout)}"; then
+        echo "Model is not healthy after ${startup_timeout}s, giving up."
+        exit 1
+    fi
+    sleep $delay
+    delay=$(awk "BEGIN {d = 2 * $delay; print (d > 2 ? 2 : d)}")
 done
-echo "Health ping passed. Start model inference..."
+startup_s=$(awk "BEGIN {print $(date +%s.%N) - $start_time}")
+echo "Health ping passed after ${startup_s}s. Start model inference..."
+python -c "import sys; from dynalab_cli.utils import print_metrics; print_metrics({'startup_s': float(sys.argv[1])})" $startup_s
 
 # run inference
 endpoint_url="http://127.0.0.1:8080/predictions/$model_name"
-python -c "import sys; from dynalab.tasks.task_io import TaskIO; TaskIO(sys.argv[1]).test_endpoint_individually(sys.argv[2])" $task $endpoint_url
+python -c "import sys; from dynalab.tasks.task_io import TaskIO; TaskIO(sys.argv[1]).test_endpoint_individually(sys.argv[2])" $task $endpoint_url || exit 1
+
+# load test with concurrent requests, closed loop unless LOAD_TEST_RATE (qps) is set.
+# The metrics are always printed, the integrated test fails on errors unless the
+# performance budget sets max_error_rate
+echo "Load testing the model..."
+python -c "import sys; from dynalab.tasks.task_io import TaskIO; from dynalab_cli.utils import print_metrics; print_metrics(TaskIO(sys.argv[1]).load_test_endpoint(sys.argv[2], num_requests=int(sys.argv[3]), concurrency=int(sys.argv[4]), rate=float(sys.argv[5]) or None, max_error_rate=1.0))" $task $endpoint_url ${LOAD_TEST_REQUESTS:-200} ${LOAD_TEST_CONCURRENCY:-8} ${LOAD_TEST_RATE:-0}
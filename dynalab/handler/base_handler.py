@@ -3,16 +3,69 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import atexit
+import inspect
+import json
+import logging
 import os
+import statistics
+import time
+from collections import OrderedDict
 
 import torch
 from ts.torch_handler.base_handler import BaseHandler
 
+from dynalab.handler.bucketing import LengthBucketer
+from dynalab.handler.cache import ResponseCache
+from dynalab.handler.metrics import LatencyRecorder, torchserve_metrics_sink
+from dynalab.handler.scheduler import MicroBatchScheduler
+from dynalab.handler.shared_weights import load_shared_state_dict
+from dynalab.handler.streaming import stream_jsonl
+from dynalab.handler.threads import apply_thread_policy, get_thread_policy
+from dynalab.handler.traffic import TrafficRecorder
+from dynalab.tasks.task_io import ROOTPATH
+from dynalab_cli.utils import SetupConfigHandler
+
+
+logger = logging.getLogger(__name__)
+
+
+def _accepts_argument(func, name):
+    try:
+        return name in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _has_model_dtypes(model, state_dict):
+    """
+    Whether every tensor of state_dict has the dtype of the parameter or
+    buffer of model it is loaded into
+    """
+    tensors = dict(model.named_parameters())
+    tensors.update(model.named_buffers())
+    return all(
+        tensors[name].dtype == tensor.dtype
+        for name, tensor in state_dict.items()
+        if name in tensors
+    )
+
 
 class BaseDynaHandler(BaseHandler):
     def __init__(self):
         super().__init__()
         self.initialized = False
+        self.scheduler = None
+        self.response_cache = None
+        self.bucketer = None
+        self.warmup_stats = None
+        self.latency_recorder = None
+        self.report_latency_to_torchserve = False
+        self.setup_config = dict()
+        self.setup_config_overrides = dict()
+        self.thread_policy = None
+        self.stream_chunk_size = None
+        self.traffic_recorder = None
 
     def _handler_initialize(self, context):
         """
@@ -32,5 +85,458 @@ class BaseDynaHandler(BaseHandler):
 
         return model_pt_path, model_file_dir, device_str
 
+    def _load_setup_config(self, context):
+        """
+        Return the setup_config.json of the model, or an empty config
+        if it cannot be found
+        """
+        for root_dir in (".", ROOTPATH):
+            try:
+                config_handler = SetupConfigHandler(
+                    context.model_name, root_dir=root_dir
+                )
+            except ValueError:
+                # torchserve accepts model names that dynalab-cli does not
+                return dict()
+            if config_handler.config_exists():
+                return config_handler.load_config()
+        return dict()
+
+    def _set_thread_policy(self, context):
+        """
+        Split the cpus allowed to the container between the torchserve workers,
+        instead of letting each worker use all the cores of the host. The
+        "threads" field of setup_config.json overrides the detected values.
+        """
+        # the mock torchserve context used by local tests has no server version
+        in_torchserve = context.system_properties.get("server_version") is not None
+        self.thread_policy = get_thread_policy(
+            self.setup_config.get("threads"), in_torchserve=in_torchserve
+        )
+        apply_thread_policy(self.thread_policy)
+
+    def _load_compiled_model(self, context):
+        """
+        Replace self.model by the TorchScript model built by dynalab-cli compile,
+        if setup_config.json points to one
+        """
+        compiled_model = self.setup_config.get("compiled_model")
+        if not compiled_model:
+            return
+        candidates = [
+            # packaged in the .mar as an extra file
+            os.path.join(
+                context.system_properties["model_dir"], os.path.basename(compiled_model)
+            ),
+            compiled_model,
+            os.path.join(ROOTPATH, compiled_model),
+        ]
+        path = next((path for path in candidates if os.path.exists(path)), None)
+        if path is None:
+            raise RuntimeError(f"Compiled model {compiled_model} not found")
+        if not isinstance(getattr(self, "model", None), torch.nn.Module):
+            raise RuntimeError(
+                "Compiled models need the handler to keep its model in self.model"
+            )
+        device = next(self.model.parameters(), torch.empty(0)).device
+        self.model = torch.jit.load(path, map_location=device)
+        self.model.eval()
+        logger.info(f"Using the compiled model {path} in place of the eager model")
+        if self.warmup_stats is not None:
+            # the warm-up of initialize ran on the eager model
+            self.warmup(self.warmup_stats["num_iterations"])
+
+    def _quantize_model(self, model):
+        """
+        Return a copy of model with its Linear layers dynamically quantized
+        to int8, which only runs on cpu
+        """
+        quantization = getattr(torch, "ao", torch).quantization
+        return quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    def _apply_quantization(self):
+        """
+        Quantize self.model after initialize if setup_config.json asks for it
+        """
+        if self.setup_config.get("quantization") != "dynamic_int8":
+            return
+        if not isinstance(getattr(self, "model", None), torch.nn.Module):
+            raise RuntimeError(
+                "Quantization needs the handler to keep its model in self.model"
+            )
+        if isinstance(self.model, torch.jit.ScriptModule):
+            logger.warning("Compiled models cannot be quantized, skipping it")
+            return
+        if any(param.is_cuda for param in self.model.parameters()):
+            logger.warning("Dynamic quantization only runs on cpu, skipping it")
+            return
+        self.model = self._quantize_model(self.model)
+        logger.info("Quantized the Linear layers of the model to int8")
+        if self.warmup_stats is not None:
+            # the warm-up of initialize ran on the fp32 model
+            self.warmup(self.warmup_stats["num_iterations"])
+
+    def _load_checkpoint(self, model_pt_path, device_str="cpu"):
+        """
+        Load a checkpoint without reading it into private memory when possible:
+        safetensors files, and torch.load(mmap=True) on torch>=2.1, map the
+        file into memory, so that the tensors are backed by the page cache
+        that all the workers share. Falls back to a plain torch.load.
+        """
+        if model_pt_path.endswith(".safetensors"):
+            try:
+                from safetensors.torch import load_file
+            except ImportError:
+                raise RuntimeError(
+                    "The safetensors package is needed to load "
+                    f"{model_pt_path}, please add it to your requirements"
+                )
+            return load_file(model_pt_path, device=device_str)
+
+        if _accepts_argument(torch.load, "mmap"):
+            try:
+                return torch.load(model_pt_path, map_location=device_str, mmap=True)
+            except RuntimeError:
+                # mmap needs a checkpoint saved with the zipfile format
+                logger.info(f"Unable to mmap {model_pt_path}, reading it instead")
+        return torch.load(model_pt_path, map_location=device_str)
+
+    def _load_model_weights(self, model, model_pt_path, device_str="cpu", shared=False):
+        """
+        Load the state dict at model_pt_path into model with _load_checkpoint.
+        On torch>=2.1 the parameters of model are replaced by the loaded
+        tensors instead of being copied into, so that they stay memory-mapped,
+        unless the checkpoint holds other dtypes than the model.
+        With shared=True on cpu, the weights are placed in shared memory by
+        the first worker and the other workers attach to them read-only.
+        """
+        if shared and device_str == "cpu":
+            state_dict = load_shared_state_dict(
+                model_pt_path, lambda path: self._load_checkpoint(path, "cpu")
+            )
+            model.load_state_dict(state_dict)
+            # point the parameters to the shared tensors instead of copies,
+            # except those load_state_dict had to cast to the model dtype
+            tensors = dict(model.named_parameters())
+            tensors.update(model.named_buffers())
+            for name, tensor in state_dict.items():
+                if name in tensors and tensors[name].dtype == tensor.dtype:
+                    tensors[name].data = tensor
+            return model
+
+        if shared:
+            logger.info(f"Weights can only be shared on cpu, not on {device_str}")
+        state_dict = self._load_checkpoint(model_pt_path, device_str)
+        # assign keeps the dtype of the checkpoint, e.g. it would turn a fp32
+        # model into fp16, so only use it when no tensor needs a cast
+        assign = _accepts_argument(model.load_state_dict, "assign")
+        if assign and _has_model_dtypes(model, state_dict):
+            model.load_state_dict(state_dict, assign=True)
+        else:
+            model.load_state_dict(state_dict)
+        return model
+
     def _read_data(self, data):
         return data[0]["body"]
+
+    def _get_body(self, request):
+        body = request.get("body")
+        if body is None:
+            body = request.get("data")
+        return body
+
+    def _read_batch(self, data):
+        """
+        Decode all torchserve requests into one flat list of examples.
+        A request body is either a single json example, or a string of
+        newline delimited json examples. The returned layout records how
+        many examples came from each request, and is used by _write_batch
+        to send the responses back in the same shape.
+        """
+        examples, layout = [], []
+        for request in data:
+            body = self._get_body(request)
+            if isinstance(body, (bytes, bytearray)):
+                body = body.decode("utf-8")
+            if isinstance(body, str):
+                # not splitlines, which also splits on the U+2028, U+2029 and
+                # U+0085 left unescaped in strings by ensure_ascii=False
+                lines = [json.loads(ln) for ln in body.split("\n") if ln.strip()]
+                examples.extend(lines)
+                layout.append(len(lines))
+            else:
+                examples.append(body)
+                layout.append(None)
+        return examples, layout
+
+    def _write_batch(self, responses, layout):
+        """
+        Scatter the responses back to their torchserve requests, following the
+        layout returned by _read_batch. Each single example request gets its
+        response object, and each batched request gets one newline delimited
+        string with one json response per example.
+        """
+        num_examples = sum(1 if n is None else n for n in layout)
+        assert len(responses) == num_examples, (
+            f"postprocess returned {len(responses)} responses "
+            f"for {num_examples} examples"
+        )
+        outputs, start = [], 0
+        for n in layout:
+            if n is None:
+                outputs.append(responses[start])
+                start += 1
+            else:
+                outputs.append(
+                    "\n".join(
+                        json.dumps(response, ensure_ascii=False)
+                        for response in responses[start : start + n]
+                    )
+                )
+                start += n
+        return outputs
+
+    def _infer_examples(self, examples):
+        if self.latency_recorder is None:
+            input_data = self.preprocess(examples)
+            return self.inference(input_data)
+        with self.latency_recorder.time("preprocess"):
+            input_data = self.preprocess(examples)
+        with self.latency_recorder.time("inference"):
+            return self.inference(input_data)
+
+    def _handle_examples(self, examples):
+        """
+        Run preprocess, inference and postprocess on a list of examples.
+        postprocess must return one response per example, in the same order.
+        """
+        if self.bucketer is not None:
+            output = self.bucketer.run(examples, self._infer_examples)
+        else:
+            output = self._infer_examples(examples)
+        if self.latency_recorder is None:
+            return self.postprocess(output, examples)
+        with self.latency_recorder.time("postprocess"):
+            return self.postprocess(output, examples)
+
+    def enable_streaming(self, chunk_size=256):
+        """
+        Parse newline delimited json bodies line by line, and run them through
+        the model chunk_size examples at a time, serializing the responses as
+        they are produced. Only one chunk of preprocessed examples and
+        intermediate tensors is then in memory at a time, but examples of
+        different requests are no longer batched together.
+        """
+        self.stream_chunk_size = chunk_size
+
+    def enable_traffic_recording(
+        self, directory, max_bytes=64 * 1024 * 1024, backup_count=5
+    ):
+        """
+        Record the body of every request, with its arrival time, in a gzip
+        compressed newline delimited json file of directory, one per worker.
+        Files are rotated every max_bytes, keeping backup_count old files.
+        They can be replayed with dynalab.handler.traffic.replay or
+        dynalab-cli replay.
+        """
+        path = os.path.join(directory, f"traffic-{os.getpid()}.jsonl.gz")
+        self.traffic_recorder = TrafficRecorder(
+            path, max_bytes=max_bytes, backup_count=backup_count
+        )
+        atexit.register(self.traffic_recorder.close)
+
+    def enable_length_bucketing(
+        self, length_fn=None, max_bucket_size=32, max_bucket_tokens=None
+    ):
+        """
+        Run preprocess and inference separately on buckets of examples of
+        similar length, to limit padding. inference must then return one
+        output per example: the outputs of all buckets are put back in the
+        original order before postprocess. length_fn defaults to the number
+        of characters of the example, padding statistics are available from
+        self.bucketer.get_stats()
+        """
+        self.bucketer = LengthBucketer(
+            length_fn=length_fn,
+            max_bucket_size=max_bucket_size,
+            max_bucket_tokens=max_bucket_tokens,
+        )
+
+    def enable_micro_batching(self, max_batch_size=8, max_wait_ms=5):
+        """
+        Route examples through a MicroBatchScheduler, so that examples coming
+        from concurrent calls to handle share one inference call. Batch fill
+        and queue depth statistics are available from self.scheduler.get_stats()
+        Torchserve calls handle of a worker one request batch at a time, so
+        there the examples of one call are never waited on: tune batch_size
+        and max_batch_delay of the model instead.
+        """
+        self.scheduler = MicroBatchScheduler(
+            self._handle_examples,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+        )
+
+    def enable_response_cache(self, max_size=1024, ttl=None, max_bytes=None):
+        """
+        Serve repeated examples from a bounded LRU cache of model outputs,
+        keyed by the task inputs of each example. ttl is in seconds, entries
+        never expire if it is None. max_bytes bounds the size of the cached
+        outputs serialized as json. Needs self.taskIO to be set, hit and miss
+        counters are available from self.response_cache.get_stats()
+        """
+        self.response_cache = ResponseCache(
+            self.taskIO, max_size=max_size, ttl=ttl, max_bytes=max_bytes
+        )
+
+    def enable_latency_metrics(self, sink=None, window=1024):
+        """
+        Time handle, preprocess, inference, postprocess and every call to
+        self.taskIO.sign_response, keeping the last window latencies of each
+        stage. Every latency is also passed to sink(stage, latency_ms); by
+        default it is reported to the torchserve metrics when available.
+        Percentiles are available from self.latency_recorder.get_stats()
+        """
+        if self.latency_recorder is None:
+            sign_response = self.taskIO.sign_response
+
+            def timed_sign_response(response, data):
+                with self.latency_recorder.time("sign_response"):
+                    sign_response(response, data)
+
+            self.taskIO.sign_response = timed_sign_response
+        self.latency_recorder = LatencyRecorder(sink=sink, window=window)
+        self.report_latency_to_torchserve = sink is None
+
+    def warmup(self, num_iterations=3):
+        """
+        Run the mock data of self.taskIO through the model num_iterations
+        times, so that lazy initializations (e.g. CUDA or MKL kernels,
+        allocator growth, tokenizer caches) are paid before the first request.
+        Call it at the end of initialize, before setting self.initialized.
+        """
+        if num_iterations <= 0:
+            return None
+        mock_datapoints, _ = self.taskIO.get_mock_data()
+        latencies = []
+        for _ in range(num_iterations):
+            start = time.perf_counter()
+            self._handle_examples(mock_datapoints)
+            latencies.append((time.perf_counter() - start) * 1000)
+        if self.bucketer is not None:
+            self.bucketer.reset_stats()
+        if self.latency_recorder is not None:
+            self.latency_recorder.reset()
+
+        first_call_ms = latencies[0]
+        steady_state_ms = (
+            statistics.median(latencies[1:]) if num_iterations > 1 else first_call_ms
+        )
+        self.warmup_stats = {
+            "num_iterations": num_iterations,
+            "batch_size": len(mock_datapoints),
+            "warmup_ms": sum(latencies),
+            "first_call_ms": first_call_ms,
+            "steady_state_ms": steady_state_ms,
+        }
+        logger.info(
+            f"Warm-up took {self.warmup_stats['warmup_ms']:.1f} ms for "
+            f"{num_iterations} iterations of {len(mock_datapoints)} examples. "
+            f"First call took {first_call_ms:.1f} ms, steady state takes "
+            f"{steady_state_ms:.1f} ms "
+            f"({first_call_ms - steady_state_ms:+.1f} ms on the first call)"
+        )
+        return self.warmup_stats
+
+    def _compute_examples(self, examples):
+        if self.scheduler is not None:
+            return self.scheduler.run(examples)
+        return self._handle_examples(examples)
+
+    def _run_examples(self, examples):
+        if self.response_cache is None:
+            return self._compute_examples(examples)
+
+        responses = [None] * len(examples)
+        # examples sharing the same inputs are only computed once
+        misses = OrderedDict()
+        for i, example in enumerate(examples):
+            key = self.response_cache.make_key(example)
+            if key in misses:
+                misses[key].append(i)
+                self.response_cache.record_hit()
+                continue
+            responses[i] = self.response_cache.get(key, example)
+            if responses[i] is None:
+                misses[key] = [i]
+        if misses:
+            computed = self._compute_examples(
+                [examples[indices[0]] for indices in misses.values()]
+            )
+            for (key, indices), response in zip(misses.items(), computed):
+                self.response_cache.put(key, response)
+                responses[indices[0]] = response
+                outputs = ResponseCache.get_outputs(response)
+                for i in indices[1:]:
+                    responses[i] = self.response_cache.make_response(
+                        outputs, examples[i]
+                    )
+        return responses
+
+    def handle(self, data, context):
+        """
+        Entry point for torchserve: every example of every request in data is
+        processed as one batch, and one output is returned per request
+        """
+        if not self.initialized:
+            self.setup_config = self._load_setup_config(context)
+            self.setup_config.update(self.setup_config_overrides)
+            self._set_thread_policy(context)
+            self.initialize(context)
+            self._load_compiled_model(context)
+            self._apply_quantization()
+        if data is None:
+            return None
+        if self.traffic_recorder is not None:
+            arrival_time = time.time()
+            for request in data:
+                self.traffic_recorder.record(self._get_body(request), arrival_time)
+        if self.latency_recorder is None:
+            return self._handle_batch(data)
+
+        if self.report_latency_to_torchserve:
+            # the metrics object of the context can change from one call to the next
+            self.latency_recorder.sink = (
+                None
+                if context.metrics is None
+                else torchserve_metrics_sink(context.metrics)
+            )
+        with self.latency_recorder.time("handle"):
+            return self._handle_batch(data)
+
+    def _handle_batch(self, data):
+        if self.stream_chunk_size is not None:
+            return self._stream_batch(data)
+        examples, layout = self._read_batch(data)
+        responses = self._run_examples(examples) if examples else []
+        return self._write_batch(responses, layout)
+
+    def _stream_batch(self, data):
+        outputs = [None] * len(data)
+        single_indices, single_examples = [], []
+        for i, request in enumerate(data):
+            body = self._get_body(request)
+            if isinstance(body, (str, bytes, bytearray)):
+                outputs[i] = stream_jsonl(
+                    body, self._run_examples, self.stream_chunk_size
+                )
+            else:
+                single_indices.append(i)
+                single_examples.append(body)
+        if single_examples:
+            responses = self._run_examples(single_examples)
+            for i, response in zip(single_indices, responses):
+                outputs[i] = response
+        return outputs
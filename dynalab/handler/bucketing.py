@@ -0,0 +1,109 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+
+
+def default_example_length(example):
+    """
+    Approximate the length of an example by the number of characters in its
+    string fields. A length based on the model tokenizer is more accurate.
+    """
+    return sum(
+        len(value)
+        for name, value in example.items()
+        if name != "uid" and isinstance(value, str)
+    )
+
+
+class LengthBucketer:
+    """
+    Groups examples of similar length together, so that a long example does
+    not force a whole batch to be padded to its length. Examples are sorted
+    by length_fn, and cut into buckets of at most max_bucket_size examples
+    and, if max_bucket_tokens is set, at most max_bucket_tokens padded
+    tokens (number of examples times the longest length in the bucket).
+    """
+
+    def __init__(self, length_fn=None, max_bucket_size=32, max_bucket_tokens=None):
+        assert max_bucket_size > 0, "max_bucket_size must be positive"
+        self.length_fn = length_fn or default_example_length
+        self.max_bucket_size = max_bucket_size
+        self.max_bucket_tokens = max_bucket_tokens
+
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.num_buckets = 0
+            self.real_tokens = 0
+            self.padded_tokens = 0
+            self.unbucketed_padded_tokens = 0
+
+    def make_buckets(self, lengths):
+        """
+        Return a list of buckets, each being the list of the indices of the
+        examples it holds, from shortest to longest
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        buckets, bucket = [], []
+        for i in order:
+            # lengths are sorted, so lengths[i] is the longest of the bucket
+            too_many_tokens = (
+                self.max_bucket_tokens is not None
+                and bucket
+                and (len(bucket) + 1) * lengths[i] > self.max_bucket_tokens
+            )
+            if len(bucket) == self.max_bucket_size or too_many_tokens:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(i)
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    def run(self, examples, run_bucket):
+        """
+        Call run_bucket on each bucket of examples. run_bucket must return
+        one output per example it is given. The outputs are returned in the
+        original order of examples.
+        """
+        lengths = [self.length_fn(example) for example in examples]
+        buckets = self.make_buckets(lengths)
+
+        outputs = [None] * len(examples)
+        for bucket in buckets:
+            bucket_outputs = run_bucket([examples[i] for i in bucket])
+            assert len(bucket_outputs) == len(bucket), (
+                f"Got {len(bucket_outputs)} outputs "
+                f"for a bucket of {len(bucket)} examples"
+            )
+            for i, output in zip(bucket, bucket_outputs):
+                outputs[i] = output
+
+        with self._lock:
+            self.num_buckets += len(buckets)
+            self.real_tokens += sum(lengths)
+            self.padded_tokens += sum(
+                len(bucket) * max(lengths[i] for i in bucket) for bucket in buckets
+            )
+            self.unbucketed_padded_tokens += len(lengths) * max(lengths, default=0)
+        return outputs
+
+    def get_stats(self):
+        """
+        Return the fraction of padded tokens that are real tokens, with and
+        without bucketing
+        """
+        with self._lock:
+            return {
+                "num_buckets": self.num_buckets,
+                "real_tokens": self.real_tokens,
+                "padded_tokens": self.padded_tokens,
+                "padding_efficiency": self.real_tokens / max(self.padded_tokens, 1),
+                "unbucketed_padding_efficiency": self.real_tokens
+                / max(self.unbucketed_padded_tokens, 1),
+            }
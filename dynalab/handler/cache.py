@@ -0,0 +1,134 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of model outputs, keyed by a canonical hash of the
+    task inputs of an example, i.e. the same fields that
+    TaskIO.parse_signature_input uses to sign a response. Cached outputs are
+    turned into a fresh response for every example, with its own id and
+    signature, so they still pass TaskIO.verify_response. The cache holds at
+    most max_size entries and, if max_bytes is set, at most max_bytes of
+    outputs, measured as their json serialization.
+    """
+
+    def __init__(self, task_io, max_size=1024, ttl=None, max_bytes=None):
+        assert max_size > 0, "max_size must be positive"
+        assert max_bytes is None or max_bytes > 0, "max_bytes must be positive"
+        self.task_io = task_io
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def make_key(self, example):
+        _, inputs, _ = self.task_io.parse_signature_input(dict(), example)
+        canonical = json.dumps(
+            inputs, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+        )
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key, example):
+        """
+        Return a freshly signed response for example if the outputs for key
+        are cached, None otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None:
+                if time.monotonic() - entry[1] > self.ttl:
+                    del self._entries[key]
+                    self._num_bytes -= entry[2]
+                    self.expirations += 1
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            outputs = entry[0]
+        return self.make_response(outputs, example)
+
+    def record_hit(self):
+        """
+        Count a response served without a lookup, e.g. for an example
+        repeated within one batch
+        """
+        with self._lock:
+            self.hits += 1
+
+    @staticmethod
+    def get_outputs(response):
+        return {
+            name: value
+            for name, value in response.items()
+            if name not in ("id", "signature")
+        }
+
+    def make_response(self, outputs, example):
+        """
+        Build a new response for example holding a copy of outputs, signed
+        with the inputs of example
+        """
+        response = dict()
+        response["id"] = example["uid"]
+        response.update(copy.deepcopy(outputs))
+        self.task_io.sign_response(response, example)
+        return response
+
+    def put(self, key, response):
+        outputs = copy.deepcopy(ResponseCache.get_outputs(response))
+        num_bytes = len(json.dumps(outputs, ensure_ascii=False).encode("utf-8"))
+        if self.max_bytes is not None and num_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._num_bytes -= self._entries[key][2]
+            self._entries[key] = (outputs, time.monotonic(), num_bytes)
+            self._entries.move_to_end(key)
+            self._num_bytes += num_bytes
+            while len(self._entries) > self.max_size or (
+                self.max_bytes is not None and self._num_bytes > self.max_bytes
+            ):
+                _, entry = self._entries.popitem(last=False)
+                self._num_bytes -= entry[2]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "num_bytes": self._num_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
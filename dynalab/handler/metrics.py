@@ -0,0 +1,101 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def torchserve_metrics_sink(metrics):
+    """
+    Return a sink that reports every latency to the torchserve metrics of a
+    worker, i.e. context.metrics
+    """
+
+    def sink(stage, latency_ms):
+        metrics.add_time(f"Dynalab_{stage}_latency", latency_ms, unit="ms")
+
+    return sink
+
+
+class LatencyRecorder:
+    """
+    Keeps the last window latencies (in ms) of each stage of the handler, and
+    computes their percentiles. Every latency is also passed to sink, a
+    function taking the stage name and the latency, if one is set.
+    """
+
+    def __init__(self, sink=None, window=1024):
+        assert window > 0, "window must be positive"
+        self.sink = sink
+        self.window = window
+        self._latencies = dict()
+        self._counts = dict()
+        self._lock = threading.Lock()
+
+    def record(self, stage, latency_ms):
+        with self._lock:
+            if stage not in self._latencies:
+                self._latencies[stage] = deque(maxlen=self.window)
+                self._counts[stage] = 0
+            self._latencies[stage].append(latency_ms)
+            self._counts[stage] += 1
+        if self.sink is not None:
+            self.sink(stage, latency_ms)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - start) * 1000)
+
+    def get_stats(self):
+        """
+        Return, for each stage, the number of calls and the mean and
+        percentiles of the latencies in the current window
+        """
+        with self._lock:
+            latencies = {
+                stage: sorted(values) for stage, values in self._latencies.items()
+            }
+            counts = dict(self._counts)
+        stats = dict()
+        for stage, values in latencies.items():
+            stats[stage] = {"count": counts[stage], "mean": sum(values) / len(values)}
+            for p in PERCENTILES:
+                stats[stage][f"p{p}"] = percentile(values, p)
+        return stats
+
+    def log_stats(self):
+        for stage, stats in self.get_stats().items():
+            logger.info(
+                f"{stage}: {stats['count']} calls, "
+                + ", ".join(f"p{p} {stats[f'p{p}']:.2f} ms" for p in PERCENTILES)
+            )
+
+    def reset(self):
+        with self._lock:
+            self._latencies.clear()
+            self._counts.clear()
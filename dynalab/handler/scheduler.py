@@ -0,0 +1,139 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatchScheduler:
+    """
+    Collects examples submitted by concurrent callers into micro batches of
+    at most max_batch_size examples, waiting at most max_wait_ms after the
+    first example of a batch arrived. Each batch goes through one call of
+    run_batch, and every caller gets back the responses for its own examples.
+    The wait is skipped when the last queued example ends a list given to
+    run and nothing else is queued, since no more examples are known to be
+    coming.
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=5):
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        assert max_wait_ms >= 0, "max_wait_ms must not be negative"
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+        self._worker = threading.Thread(
+            target=self._loop, name="dynalab-micro-batching", daemon=True
+        )
+        self._worker.start()
+
+    def reset_stats(self):
+        with self._lock:
+            self.num_batches = 0
+            self.num_examples = 0
+            self.num_full_batches = 0
+            self.max_queue_depth = 0
+            self.total_wait_ms = 0.0
+
+    def submit(self, example, last=False):
+        """
+        Queue one example and return a Future that resolves to its response.
+        last tells that the caller submits nothing after this example.
+        """
+        future = Future()
+        self._queue.put((example, future, time.perf_counter(), last))
+        depth = self._queue.qsize()
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+        return future
+
+    def run(self, examples):
+        """
+        Queue a list of examples and block until all their responses are ready
+        """
+        futures = [
+            self.submit(example, last=i == len(examples) - 1)
+            for i, example in enumerate(examples)
+        ]
+        return [future.result() for future in futures]
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if batch[-1][3] and self._queue.empty():
+                    break
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            examples = [example for example, _, _, _ in batch]
+            futures = [future for _, future, _, _ in batch]
+            try:
+                responses = self.run_batch(examples)
+                assert len(responses) == len(examples), (
+                    f"Got {len(responses)} responses "
+                    f"for a batch of {len(examples)} examples"
+                )
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future, response in zip(futures, responses):
+                    future.set_result(response)
+
+            with self._lock:
+                self.num_batches += 1
+                self.num_examples += len(batch)
+                if len(batch) == self.max_batch_size:
+                    self.num_full_batches += 1
+                self.total_wait_ms += sum(
+                    (start - arrival) * 1000 for _, _, arrival, _ in batch
+                )
+            logger.debug(
+                f"Ran a micro batch of {len(batch)} / {self.max_batch_size} "
+                f"examples, {self._queue.qsize()} examples still queued"
+            )
+
+    def get_stats(self):
+        """
+        Return queue depth and batch fill statistics, to help tune
+        max_batch_size and max_wait_ms
+        """
+        with self._lock:
+            num_batches = max(self.num_batches, 1)
+            num_examples = max(self.num_examples, 1)
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "num_batches": self.num_batches,
+                "num_examples": self.num_examples,
+                "avg_batch_size": self.num_examples / num_batches,
+                "avg_batch_fill": self.num_examples
+                / (num_batches * self.max_batch_size),
+                "full_batch_ratio": self.num_full_batches / num_batches,
+                "avg_queue_wait_ms": self.total_wait_ms / num_examples,
+            }
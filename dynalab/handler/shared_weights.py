@@ -0,0 +1,224 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import warnings
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+SHM_DIR = "/dev/shm"
+ALIGNMENT = 64
+
+SHAREABLE_DTYPES = (
+    torch.float64,
+    torch.float32,
+    torch.float16,
+    torch.bfloat16,
+    torch.int64,
+    torch.int32,
+    torch.int16,
+    torch.int8,
+    torch.uint8,
+    torch.bool,
+)
+DTYPE_NAMES = {str(dtype): dtype for dtype in SHAREABLE_DTYPES}
+
+
+def get_numpy_dtypes():
+    """
+    Numpy dtype holding each shareable torch dtype. numpy is imported here so
+    that handlers which do not share their weights do not need it.
+    """
+    import numpy as np
+
+    # bfloat16 has no numpy equivalent, it is stored as int16 and viewed back
+    return {
+        torch.float64: np.float64,
+        torch.float32: np.float32,
+        torch.float16: np.float16,
+        torch.bfloat16: np.int16,
+        torch.int64: np.int64,
+        torch.int32: np.int32,
+        torch.int16: np.int16,
+        torch.int8: np.int8,
+        torch.uint8: np.uint8,
+        torch.bool: np.bool_,
+    }
+
+
+def get_segment_path(checkpoint_path, shm_dir=None):
+    """
+    Path of the shared segment of a checkpoint. The name depends on the
+    checkpoint path, size and modification time, so that an updated
+    checkpoint never attaches to the segment of an older one.
+    """
+    stat = os.stat(checkpoint_path)
+    key = f"{os.path.realpath(checkpoint_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    name = "dynalab-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    if shm_dir is None:
+        # reuse the segment another worker started, whatever the free space
+        # left after it, so that the weights are never copied twice
+        for segment_dir in (SHM_DIR, tempfile.gettempdir()):
+            if os.path.exists(os.path.join(segment_dir, name + ".lock")):
+                return os.path.join(segment_dir, name)
+        shm_dir = SHM_DIR
+        # docker limits /dev/shm to 64MB by default
+        if not os.path.isdir(shm_dir) or (
+            shutil.disk_usage(shm_dir).free < 2 * stat.st_size
+        ):
+            shm_dir = tempfile.gettempdir()
+    return os.path.join(shm_dir, name)
+
+
+def _get_segment_dirs(segment_path, shm_dir=None):
+    if shm_dir is not None:
+        return [shm_dir]
+    # get_segment_path falls back to the temporary directory
+    return sorted({os.path.dirname(segment_path), SHM_DIR, tempfile.gettempdir()})
+
+
+def _remove_segment(segment_path):
+    for suffix in ("", ".json", ".source", ".lock"):
+        try:
+            os.remove(segment_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def remove_stale_segments(checkpoint_path, segment_path, shm_dir=None):
+    """
+    Remove the segments of older versions of checkpoint_path, i.e. the
+    segments written for the same path but another size or modification
+    time. Workers still attached to them keep their mapping until they exit.
+    Segments in use by a worker copying them are left alone.
+    """
+    realpath = os.path.realpath(checkpoint_path)
+    for segment_dir in _get_segment_dirs(segment_path, shm_dir):
+        if not os.path.isdir(segment_dir):
+            continue
+        for name in os.listdir(segment_dir):
+            if not (name.startswith("dynalab-") and name.endswith(".source")):
+                continue
+            stale_path = os.path.join(segment_dir, name[: -len(".source")])
+            if stale_path == segment_path:
+                continue
+            try:
+                with open(stale_path + ".source") as f:
+                    if f.read() != realpath:
+                        continue
+            except FileNotFoundError:
+                continue
+            with open(stale_path + ".lock", "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                logger.info(f"Removing {stale_path}, shared for an older checkpoint")
+                _remove_segment(stale_path)
+
+
+def _write_segment(segment_path, state_dict):
+    entries, offset = [], 0
+    tmp_path = segment_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for name, tensor in state_dict.items():
+            if not isinstance(tensor, torch.Tensor):
+                raise RuntimeError(
+                    f"Only state dicts of tensors can be shared, got "
+                    f"{type(tensor).__name__} for {name}"
+                )
+            if tensor.dtype not in SHAREABLE_DTYPES:
+                raise RuntimeError(f"Unable to share tensor {name} of {tensor.dtype}")
+            padding = -offset % ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+
+            tensor = tensor.detach().cpu().contiguous()
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            array = tensor.numpy()
+            f.write(memoryview(array.reshape(-1)).cast("B"))
+            entries.append(
+                {
+                    "name": name,
+                    "dtype": str(state_dict[name].dtype),
+                    "shape": list(array.shape),
+                    "offset": offset,
+                }
+            )
+            offset += array.nbytes
+        f.flush()
+        os.fsync(f.fileno())
+    with open(segment_path + ".json.tmp", "w") as f:
+        json.dump(entries, f)
+    # the segment is only visible to other workers once it is complete
+    os.rename(tmp_path, segment_path)
+    os.rename(segment_path + ".json.tmp", segment_path + ".json")
+
+
+def _attach_segment(segment_path):
+    import numpy as np
+
+    numpy_dtypes = get_numpy_dtypes()
+    with open(segment_path + ".json") as f:
+        entries = json.load(f)
+    with open(segment_path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    state_dict = dict()
+    with warnings.catch_warnings():
+        # the tensors are read-only on purpose
+        warnings.simplefilter("ignore", UserWarning)
+        for entry in entries:
+            dtype = DTYPE_NAMES[entry["dtype"]]
+            count = int(np.prod(entry["shape"], dtype=np.int64))
+            array = np.frombuffer(
+                buffer,
+                dtype=numpy_dtypes[dtype],
+                count=count,
+                offset=entry["offset"],
+            ).reshape(entry["shape"])
+            tensor = torch.from_numpy(array)
+            if dtype == torch.bfloat16:
+                tensor = tensor.view(torch.bfloat16)
+            state_dict[entry["name"]] = tensor
+    return state_dict
+
+
+def load_shared_state_dict(checkpoint_path, load_fn, shm_dir=None):
+    """
+    Return the state dict of checkpoint_path as read-only cpu tensors backed
+    by one shared memory segment. The first worker to get here loads the
+    checkpoint with load_fn and copies it into the segment, the next workers
+    only map the segment, so the weights are held once in memory whatever
+    the number of workers. Writing the segment of an updated checkpoint
+    removes the segments of its older versions.
+    """
+    segment_path = get_segment_path(checkpoint_path, shm_dir)
+    with open(segment_path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(segment_path + ".json"):
+                logger.info(f"Copying {checkpoint_path} into {segment_path}")
+                # lets remove_stale_segments find the segment once outdated
+                with open(segment_path + ".source", "w") as f:
+                    f.write(os.path.realpath(checkpoint_path))
+                _write_segment(segment_path, load_fn(checkpoint_path))
+                remove_stale_segments(checkpoint_path, segment_path, shm_dir)
+            else:
+                logger.info(f"Attaching to the weights shared in {segment_path}")
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return _attach_segment(segment_path)
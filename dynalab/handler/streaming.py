@@ -0,0 +1,76 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import io
+import json
+
+
+def iter_lines(body):
+    """
+    Iterate over the lines of a str or bytes body without splitting
+    the whole body at once
+    """
+    newline = "\n" if isinstance(body, str) else b"\n"
+    start = 0
+    while start < len(body):
+        end = body.find(newline, start)
+        if end == -1:
+            end = len(body)
+        yield body[start:end]
+        start = end + 1
+
+
+def iter_jsonl_chunks(body, chunk_size):
+    """
+    Parse a newline delimited json body into lists of at most chunk_size
+    examples, one list at a time
+    """
+    chunk = []
+    for line in iter_lines(body):
+        if not line.strip():
+            continue
+        chunk.append(json.loads(line))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class JsonlResponseWriter:
+    """
+    Serializes responses into one newline delimited json string as they are
+    produced, so that only their serialized form is kept in memory
+    """
+
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self.num_responses = 0
+
+    def write(self, responses):
+        for response in responses:
+            if self.num_responses > 0:
+                self._buffer.write("\n")
+            self._buffer.write(json.dumps(response, ensure_ascii=False))
+            self.num_responses += 1
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+
+def stream_jsonl(body, run_examples, chunk_size=256):
+    """
+    Run a newline delimited json body through run_examples chunk by chunk,
+    and return the newline delimited json responses. Memory only grows with
+    the body, the serialized responses and one chunk of examples.
+    """
+    writer = JsonlResponseWriter()
+    for examples in iter_jsonl_chunks(body, chunk_size):
+        responses = run_examples(examples)
+        assert len(responses) == len(examples), (
+            f"Got {len(responses)} responses for a chunk of {len(examples)} examples"
+        )
+        writer.write(responses)
+    return writer.getvalue()
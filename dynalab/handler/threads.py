@@ -0,0 +1,107 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import math
+import os
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_cgroup_cpu_quota():
+    """
+    Return the number of cpus allowed by the cgroup cpu quota, e.g. 4 for
+    docker run --cpus=4, or None if there is no quota
+    """
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def get_available_cpus():
+    """
+    Number of cpus this process can use, taking into account both the cpu
+    affinity and the cgroup quota
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = get_cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(int(math.ceil(quota)), 1))
+    return cpus
+
+
+def get_torchserve_num_workers(default):
+    """
+    Number of workers torchserve starts for each model: read from the
+    environment or the torchserve config file, otherwise default
+    """
+    num_workers = os.environ.get("TS_DEFAULT_WORKERS_PER_MODEL")
+    config_file = os.environ.get("TS_CONFIG_FILE")
+    if num_workers is None and config_file and os.path.exists(config_file):
+        with open(config_file) as f:
+            for line in f:
+                key, _, value = line.partition("=")
+                if key.strip() == "default_workers_per_model":
+                    num_workers = value.strip()
+    try:
+        return max(int(num_workers), 1)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_thread_policy(threads_config=None, in_torchserve=True):
+    """
+    Split the available cpus between the workers. Each field of
+    threads_config ("num_workers", "intra_op", "inter_op") overrides the
+    detected value. torchserve starts one worker per cpu by default.
+    """
+    threads_config = threads_config or dict()
+    cpus = get_available_cpus()
+    num_workers = threads_config.get("num_workers")
+    if num_workers is None:
+        num_workers = get_torchserve_num_workers(cpus if in_torchserve else 1)
+    return {
+        "cpus": cpus,
+        "num_workers": num_workers,
+        "intra_op": threads_config.get("intra_op", max(cpus // num_workers, 1)),
+        "inter_op": threads_config.get("inter_op", 1),
+    }
+
+
+def apply_thread_policy(policy):
+    torch.set_num_threads(policy["intra_op"])
+    try:
+        torch.set_num_interop_threads(policy["inter_op"])
+    except RuntimeError as e:
+        # it can only be set once, before any inter-op parallel work
+        logger.warning(f"Unable to set the number of inter-op threads: {e}")
+    logger.info(
+        f"Using {policy['intra_op']} intra-op and {policy['inter_op']} inter-op "
+        f"threads per worker, for {policy['num_workers']} workers "
+        f"on {policy['cpus']} cpus"
+    )
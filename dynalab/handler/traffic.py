@@ -0,0 +1,260 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import base64
+import glob
+import gzip
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from dynalab.handler.metrics import PERCENTILES, percentile
+
+
+logger = logging.getLogger(__name__)
+
+
+def encode_body(body, arrival_time):
+    record = {"time": arrival_time}
+    if isinstance(body, (bytes, bytearray)):
+        try:
+            record["body"] = bytes(body).decode("utf-8")
+            record["bytes"] = True
+        except UnicodeDecodeError:
+            record["body_base64"] = base64.b64encode(body).decode("ascii")
+    else:
+        record["body"] = body
+    return record
+
+
+def decode_body(record):
+    if "body_base64" in record:
+        return base64.b64decode(record["body_base64"])
+    if record.get("bytes"):
+        return record["body"].encode("utf-8")
+    return record["body"]
+
+
+class TrafficRecorder:
+    """
+    Appends request bodies with their arrival time (seconds since the epoch)
+    to a gzip compressed newline delimited json file. Once the file holds
+    max_bytes of compressed data, it is rotated like logging's
+    RotatingFileHandler: path becomes path.1, path.1 becomes path.2 and so
+    on, keeping at most backup_count old files. Records are flushed every
+    flush_every records, so that at most that many are lost if the process
+    gets killed.
+    """
+
+    def __init__(
+        self, path, max_bytes=64 * 1024 * 1024, backup_count=5, flush_every=64
+    ):
+        assert max_bytes > 0, "max_bytes must be positive"
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_every = flush_every
+        self.num_records = 0
+        self._num_unflushed = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._open()
+
+    def _open(self):
+        # appending starts a new gzip member, which gzip readers handle
+        self._raw = open(self.path, "ab")
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="ab")
+
+    def _close(self):
+        self._file.close()
+        self._raw.close()
+
+    def _rotate(self):
+        self._close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def record(self, body, arrival_time=None):
+        if arrival_time is None:
+            arrival_time = time.time()
+        line = json.dumps(encode_body(body, arrival_time), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line.encode("utf-8") + b"\n")
+            self.num_records += 1
+            self._num_unflushed += 1
+            if self._num_unflushed >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        self._file.flush()
+        self._raw.flush()
+        self._num_unflushed = 0
+        if self._raw.tell() >= self.max_bytes:
+            self._rotate()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._close()
+
+
+def get_traffic_files(paths):
+    """
+    Expand paths (files, directories or glob patterns) into the recorded
+    files, grouped by recorder, each group ordered from the oldest rotated
+    file to the current one
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, "*.jsonl.gz*")))
+        else:
+            files.extend(glob.glob(path) or [path])
+
+    groups = dict()
+    for f in sorted(set(files)):
+        match = re.match(r"^(.*?)(?:\.(\d+))?$", f)
+        base, index = match.group(1), int(match.group(2) or 0)
+        if not base.endswith(".gz"):
+            base, index = f, 0
+        groups.setdefault(base, []).append((index, f))
+    return [
+        [f for _, f in sorted(group, reverse=True)]
+        for _, group in sorted(groups.items())
+    ]
+
+
+def iter_traffic_file(path):
+    """
+    Yield the records of a recorded file, skipping the end of a file that
+    was cut short, e.g. when its worker was killed
+    """
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping a truncated record in {path}")
+    except (EOFError, zlib.error):
+        logger.warning(f"{path} is truncated, replaying its complete records only")
+
+
+def read_traffic(paths):
+    """
+    Yield the records of all the recorded files in paths, e.g. one per
+    torchserve worker, merged by arrival time
+    """
+
+    def iter_group(group):
+        for path in group:
+            yield from iter_traffic_file(path)
+
+    yield from heapq.merge(
+        *(iter_group(group) for group in get_traffic_files(paths)),
+        key=lambda record: record["time"],
+    )
+
+
+def http_sender(url, timeout=None):
+    """
+    Return a send(body) function posting bodies to url, with one keep-alive
+    session per thread, and returning the response
+    """
+    # imported here so that handlers do not depend on requests
+    import requests
+
+    local = threading.local()
+
+    def send(body):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        if isinstance(body, dict):
+            r = local.session.post(url, json=body, timeout=timeout)
+        else:
+            r = local.session.post(url, data=body, timeout=timeout)
+        r.raise_for_status()
+        return r
+
+    return send
+
+
+def replay(records, send, speed=1.0, concurrency=1):
+    """
+    Call send(body) on the body of each record from concurrency threads,
+    keeping the original gaps between arrivals divided by speed, or as fast
+    as possible if speed is None. Returns the latency percentiles, the
+    errors counted by type and how far behind the original schedule the
+    replay fell. Unless speed is None, latencies are measured from the
+    scheduled arrival of each request, so that they include the time spent
+    waiting for a free thread like in an open loop.
+    """
+    assert speed is None or speed > 0, "speed must be positive"
+    latencies, errors, error_counts = [], [], dict()
+    lock = threading.Lock()
+    # bounds the number of records read ahead of the requests
+    slots = threading.BoundedSemaphore(2 * concurrency)
+
+    def run(body, scheduled=None):
+        try:
+            start = time.perf_counter() if scheduled is None else scheduled
+            send(body)
+            latency_ms = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(latency_ms)
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+                name = type(e).__name__
+                error_counts[name] = error_counts.get(name, 0) + 1
+        finally:
+            slots.release()
+
+    max_lag, first_time, scheduled = 0.0, None, None
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record in records:
+            if speed is not None:
+                if first_time is None:
+                    first_time = record["time"]
+                scheduled = start + (record["time"] - first_time) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            if speed is not None:
+                max_lag = max(max_lag, time.perf_counter() - scheduled)
+            executor.submit(run, decode_body(record), scheduled)
+    duration = time.perf_counter() - start
+
+    stats = {
+        "num_requests": len(latencies) + len(errors),
+        "num_errors": len(errors),
+        "duration": duration,
+        "qps": (len(latencies) + len(errors)) / duration if duration > 0 else 0.0,
+        "max_lag_ms": max_lag * 1000,
+        "error_counts": error_counts,
+        "errors": errors[:10],
+    }
+    latencies.sort()
+    for p in PERCENTILES:
+        stats[f"p{p}_ms"] = percentile(latencies, p)
+    return stats
@@ -1,10 +1,57 @@
+import base64
+import math
 import random
+import struct
+import zlib
 
 from dynalab.tasks.annotation_types import AnnotationTypeEnum
 
 
-def get_source_data(annotation, name_to_annotation_dict):
+# Every generator takes an annotation config and the configs it may reference
+# by name, and returns a list of mock values. Without rng, it returns the
+# fixed values used by TaskIO.get_mock_data. With rng, a random.Random, it
+# returns a single random value drawn according to options (see
+# DEFAULT_LOAD_OPTIONS), datum holding the values generated so far for the
+# same data point.
+
+
+def uniform_length(min_length, max_length):
+    return lambda rng: rng.randint(min_length, max_length)
+
+
+def lognormal_length(median, sigma=1.0, max_length=None):
+    def length(rng):
+        value = max(int(round(rng.lognormvariate(math.log(median), sigma))), 1)
+        return min(value, max_length) if max_length else value
+
+    return length
+
+
+def choice_of(values):
+    return lambda rng: rng.choice(values)
+
+
+DEFAULT_LOAD_OPTIONS = {
+    # number of words of string annotations
+    "string_length": lognormal_length(median=32, sigma=1.0, max_length=2048),
+    # (width, height) of image annotations
+    "image_size": choice_of([(224, 224)]),
+    # number of labels of multilabel annotations
+    "num_labels": uniform_length(1, 3),
+    # number of words of context_string_selection annotations
+    "selection_length": uniform_length(1, 8),
+}
+
+WORDS = (
+    "It is a good day Let's try utf-8 like hackamore from j?\u00a1quima; the "
+    "model answer question context of and to in that with \u00e9t\u00e9 \u6587\u5b57"
+).split()
+
+
+def get_source_data(annotation, name_to_annotation_dict, datum=None):
     source_reference_name = annotation["reference_name"]
+    if datum is not None and source_reference_name in datum:
+        return [datum[source_reference_name]]
     source_annotation = name_to_annotation_dict[source_reference_name]
     source_data = annotation_mock_data_generators[source_annotation["type"]](
         source_annotation, name_to_annotation_dict
@@ -12,7 +59,42 @@ def get_source_data(annotation, name_to_annotation_dict):
     return source_data
 
 
-def generate_image_mock_data(annotation=None, name_to_annotation_dict=None):
+def encode_png(width, height, pixels):
+    """
+    Encode raw 8 bits RGB pixels as a base64 png
+    """
+
+    def chunk(tag, data):
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+        )
+
+    row_size = 3 * width
+    # each row starts with filter type 0
+    raw = b"".join(
+        b"\0" + pixels[y * row_size : (y + 1) * row_size] for y in range(height)
+    )
+    png = (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 1))
+        + chunk(b"IEND", b"")
+    )
+    return base64.b64encode(png).decode("ascii")
+
+
+def generate_image_mock_data(
+    annotation=None, name_to_annotation_dict=None, rng=None, options=None, datum=None
+):
+    if rng is not None:
+        width, height = options["image_size"](rng)
+        num_bytes = 3 * width * height
+        pixels = rng.getrandbits(8 * num_bytes).to_bytes(num_bytes, "little")
+        return [encode_png(width, height, pixels)]
+
     base64_image_string = (
         'iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAABx0lEQVQ4T2P8'
         + '////fwYKACPVDKhq\nWcHw9etPsFvevPvMICLEy/Dt+y8GBob/DFyc7HAxkDwXJxtDe10kWC3cBQ'
@@ -27,7 +109,12 @@ def generate_image_mock_data(annotation=None, name_to_annotation_dict=None):
     return [base64_image_string]
 
 
-def generate_string_mock_data(annotation=None, name_to_annotation_dict=None):
+def generate_string_mock_data(
+    annotation=None, name_to_annotation_dict=None, rng=None, options=None, datum=None
+):
+    if rng is not None:
+        length = options["string_length"](rng)
+        return [" ".join(rng.choice(WORDS) for _ in range(length))]
     return [
         "It is a good day",
         "Let's try a utf-8 like hackamore from j?\u00a1quima;",
@@ -35,26 +122,37 @@ def generate_string_mock_data(annotation=None, name_to_annotation_dict=None):
     ]
 
 
-def generate_context_string_selection_mock_data(annotation, name_to_annotation_dict):
-    source_data = get_source_data(annotation, name_to_annotation_dict)
+def generate_context_string_selection_mock_data(
+    annotation, name_to_annotation_dict, rng=None, options=None, datum=None
+):
+    source_data = get_source_data(annotation, name_to_annotation_dict, datum)
+    if rng is not None:
+        words = source_data[0].split(" ")
+        length = min(options["selection_length"](rng), len(words))
+        start = rng.randrange(len(words) - length + 1)
+        return [" ".join(words[start : start + length])]
     return [source_str[0:10] for source_str in source_data]
 
 
-def generate_prob_mock_data(annotation, name_to_annotation_dict):
+def generate_prob_mock_data(
+    annotation, name_to_annotation_dict, rng=None, options=None, datum=None
+):
+    num_values = 3 if rng is None else 1
+    rng = rng or random
 
     if annotation.get("single_prob", False):
-        return [random.random() for _ in range(3)]
+        return [rng.random() for _ in range(num_values)]
     else:
         mock_data = []
         source_reference_name = annotation["reference_name"]
         source_annotation = name_to_annotation_dict[source_reference_name]
         labels = source_annotation["labels"]
 
-        for _ in range(3):
+        for _ in range(num_values):
             probs_dict = {}
             probs_sum = 0
             for label in labels:
-                probs_dict[label] = random.random()
+                probs_dict[label] = rng.random()
                 probs_sum += probs_dict[label]
 
             # normalize
@@ -66,14 +164,24 @@ def generate_prob_mock_data(annotation, name_to_annotation_dict):
         return mock_data
 
 
-def generate_multiclass_mock_data(annotation, name_to_annotation_dict=None):
-    labels = annotation["labels"]
+def generate_multiclass_mock_data(
+    annotation, name_to_annotation_dict=None, rng=None, options=None, datum=None
+):
+    # a copy, shuffling the config in place would change the seeded data
+    labels = list(annotation["labels"])
+    if rng is not None:
+        return [rng.choice(labels)]
     random.shuffle(labels)
     return labels
 
 
-def generate_multilabel_mock_data(annotation, name_to_annotation_dict=None):
-    labels = annotation["labels"]
+def generate_multilabel_mock_data(
+    annotation, name_to_annotation_dict=None, rng=None, options=None, datum=None
+):
+    labels = list(annotation["labels"])
+    if rng is not None:
+        num_labels = min(options["num_labels"](rng), len(labels))
+        return [rng.sample(labels, num_labels)]
     random.shuffle(labels)
     return [labels]
 
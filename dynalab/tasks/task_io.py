@@ -3,21 +3,123 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import copy
 import hashlib
 import json
+import multiprocessing
 import os
+import random
+import threading
+import time
+import traceback
 import uuid
+from collections import namedtuple
+from types import MappingProxyType
 
 import requests
 from ts.context import Context
 
-from dynalab.tasks.annotation_mock_data import annotation_mock_data_generators
+from dynalab.handler.metrics import PERCENTILES
+from dynalab.handler.traffic import http_sender, replay
+from dynalab.tasks.annotation_mock_data import (
+    DEFAULT_LOAD_OPTIONS,
+    annotation_mock_data_generators,
+)
 from dynalab.tasks.annotation_verifiers import annotation_verifiers
 from dynalab_cli.utils import SetupConfigHandler
 
 
 ROOTPATH = "/home/model-server/code"
 
+# Everything verify_response and parse_signature_input need from the task config
+TaskIOPlan = namedtuple(
+    "TaskIOPlan",
+    [
+        "task",
+        "input_names",
+        "output_names",
+        "signed_input_names",
+        "signed_output_names",
+        "target_names",
+        "name_to_config_obj",
+        "output_verifiers",
+    ],
+)
+
+
+class TaskInfoCache:
+    """
+    Process-wide cache of the task config files, keyed by their real path.
+    An entry is reloaded as soon as the modification time or the size of its
+    file changes. Next to the parsed config, an entry holds whatever TaskIO
+    compiled from it, so that all TaskIO of a task share the read-only plan.
+    The entries are never handed out to be changed: each TaskIO copies the
+    config it keeps.
+    """
+
+    def __init__(self):
+        self._entries = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.reloads = 0
+
+    def get(self, path):
+        """
+        Return the entry of the task config at path, or None if there is no
+        such file
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        realpath = os.path.realpath(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(realpath)
+            if entry is not None and entry["version"] == version:
+                self.hits += 1
+                return entry
+
+        with open(path) as f:
+            entry = {"version": version, "task_info": json.load(f)}
+        with self._lock:
+            if realpath in self._entries:
+                self.reloads += 1
+            else:
+                self.loads += 1
+            self._entries[realpath] = entry
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "loads": self.loads,
+                "reloads": self.reloads,
+            }
+
+
+task_info_cache = TaskInfoCache()
+
+# TaskIO of the current process of a verify_responses pool
+_worker_task_io = None
+
+
+def _init_verify_worker(task_io):
+    global _worker_task_io
+    _worker_task_io = task_io
+
+
+def _verify_chunk(chunk):
+    start, responses, data = chunk
+    return _worker_task_io._verify_chunk(start, responses, data)
+
 
 class TaskIO:
     def __init__(self, task_code, task_info_path=None):
@@ -28,14 +130,43 @@ class TaskIO:
             else [f"./.dynalab/{task_code}.json", f"{ROOTPATH}/{task_code}.json"]
         )
         for path in paths_to_check:
-            self.task_info = TaskIO.get_json_from_path(path)
-            if self.task_info is not None:
+            entry = task_info_cache.get(path)
+            if entry is not None:
                 break
 
-        if self.task_info is None:
+        if entry is None:
             raise RuntimeError(f"No task io found.")
 
-        self.initialize_inputs_and_targets()
+        if "compiled" not in entry:
+            self.task_info = entry["task_info"]
+            self.initialize_inputs_and_targets()
+            entry["compiled"] = (
+                self.task_info,
+                self.inputs_without_targets,
+                self.targets,
+                self.compile_plan(),
+            )
+        task_info, inputs_without_targets, targets, self.plan = entry["compiled"]
+        # each TaskIO gets its own copy of the config, so that changing it
+        # never leaks into the cache and the other TaskIO of the task
+        (
+            self.task_info,
+            self.inputs_without_targets,
+            self.targets,
+        ) = copy.deepcopy((task_info, inputs_without_targets, targets))
+        self._signature_prefixes = dict()
+
+    def __getstate__(self):
+        # the plan holds read-only mappings, which cannot be pickled
+        state = self.__dict__.copy()
+        del state["plan"]
+        del state["_signature_prefixes"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.plan = self.compile_plan()
+        self._signature_prefixes = dict()
 
     @staticmethod
     def get_json_from_path(path):
@@ -79,6 +210,35 @@ class TaskIO:
             else:
                 self.inputs_without_targets.append(input_datum)
 
+    def compile_plan(self):
+        """
+        Resolve once the names, config objects and verifiers used to sign and
+        verify responses, since they never change for a task
+        """
+        contexts = self.task_info["config"].get("context", [])
+        input_names = []
+        for annotation in self.inputs_without_targets + contexts:
+            if annotation["name"] not in input_names:
+                input_names.append(annotation["name"])
+
+        outputs = TaskIO.get_full_output_annotation_config_objs(
+            self.task_info["config"]
+        )
+        name_to_config_obj = {output["name"]: output for output in outputs}
+        return TaskIOPlan(
+            task=self.task_info["task"],
+            input_names=tuple(input_names),
+            output_names=tuple(name_to_config_obj),
+            signed_input_names=tuple(sorted(input_names)),
+            signed_output_names=tuple(sorted(name_to_config_obj)),
+            target_names=frozenset(target["name"] for target in self.targets),
+            name_to_config_obj=MappingProxyType(name_to_config_obj),
+            output_verifiers=tuple(
+                (output["name"], annotation_verifiers.get(output["type"]), output)
+                for output in outputs
+            ),
+        )
+
     def get_mock_data(self):
         mock_datapoints = []
 
@@ -172,6 +332,48 @@ class TaskIO:
 
         return mock_datapoints, sample_output
 
+    def generate_mock_data(self, num_datapoints=None, seed=0, options=None):
+        """
+        Yield num_datapoints random data points (endlessly if None), which are
+        the same for the same seed. options overrides DEFAULT_LOAD_OPTIONS
+        of dynalab.tasks.annotation_mock_data, e.g. the distribution of the
+        lengths of strings or of the sizes of images. Its "annotation_options"
+        field maps annotation names to options used for that annotation only.
+        """
+        rng = random.Random(seed)
+        options = dict(DEFAULT_LOAD_OPTIONS, **(options or dict()))
+        annotation_options = options.pop("annotation_options", dict())
+        annotations = self.inputs_without_targets + self.task_info["config"].get(
+            "context", []
+        )
+        name_to_annotation_dict = {
+            annotation["name"]: annotation for annotation in annotations
+        }
+        # generate the annotations that reference others last
+        annotations = sorted(annotations, key=lambda a: "reference_name" in a)
+        options_by_name = {
+            annotation["name"]: dict(
+                options, **annotation_options.get(annotation["name"], dict())
+            )
+            for annotation in annotations
+        }
+
+        i = 0
+        while num_datapoints is None or i < num_datapoints:
+            datum = {"uid": str(uuid.UUID(int=rng.getrandbits(128)))}
+            for annotation in annotations:
+                datum[annotation["name"]] = annotation_mock_data_generators[
+                    annotation["type"]
+                ](
+                    annotation,
+                    name_to_annotation_dict,
+                    rng,
+                    options_by_name[annotation["name"]],
+                    datum,
+                )[0]
+            yield datum
+            i += 1
+
     def get_sample_output(self):
         _, sample_output = self.get_mock_data()
         return sample_output
@@ -277,26 +479,127 @@ class TaskIO:
                 print("Your model response: ", r.text)
                 self.verify_response(r.json(), data)
 
+    def load_test_endpoint(
+        self,
+        endpoint_url,
+        num_requests=200,
+        concurrency=8,
+        rate=None,
+        seed=0,
+        timeout=60,
+        max_error_rate=0.0,
+    ):
+        """
+        Post num_requests random examples to endpoint_url from concurrency
+        threads, each keeping its connection alive, and verify every
+        response. Without rate, each thread sends its next request as soon
+        as it gets a response (closed loop). With rate, requests arrive at
+        that fixed number per second whatever the latency (open loop), as
+        long as fewer than concurrency are in flight, and latencies count
+        from the arrival of each request. Raises a RuntimeError if the error
+        rate is above max_error_rate.
+        """
+        send = http_sender(endpoint_url, timeout=timeout)
+
+        def send_and_verify(data):
+            r = send(data)
+            try:
+                self.verify_response(r.json(), data)
+            except AssertionError as e:
+                raise AssertionError(self.get_failure_reason(e)) from e
+
+        records = (
+            {"time": i / rate if rate else 0.0, "body": data}
+            for i, data in enumerate(self.generate_mock_data(num_requests, seed))
+        )
+        mode = f"open loop at {rate} qps" if rate else "closed loop"
+        print(
+            f"Load testing {endpoint_url} with {num_requests} requests, "
+            f"{concurrency} concurrent connections, {mode}..."
+        )
+        stats = replay(
+            records,
+            send_and_verify,
+            speed=1.0 if rate else None,
+            concurrency=concurrency,
+        )
+        stats["error_rate"] = stats["num_errors"] / max(stats["num_requests"], 1)
+
+        print(
+            f"{stats['num_requests']} requests in {stats['duration']:.2f} s, "
+            f"{stats['qps']:.2f} qps"
+        )
+        print(
+            "Latency: "
+            + ", ".join(f"p{p} {stats[f'p{p}_ms']:.2f} ms" for p in PERCENTILES)
+        )
+        if rate:
+            print(
+                f"Maximum delay behind the arrival rate: {stats['max_lag_ms']:.0f} ms"
+            )
+        error_counts = ", ".join(
+            f"{n} {name}" for name, n in stats["error_counts"].items()
+        )
+        print(
+            f"Error rate: {100 * stats['error_rate']:.2f}%"
+            + (f" ({error_counts})" if error_counts else "")
+        )
+        for error in stats["errors"]:
+            print(f"Error: {error}")
+        if stats["error_rate"] > max_error_rate:
+            raise RuntimeError(
+                f"Load test failed: {stats['num_errors']} of "
+                f"{stats['num_requests']} requests failed"
+            )
+        return stats
+
     def generate_response_signature(self, response, data, secret=""):
         """
         This function generates a unique signature
         based on secret, task, input and output
         """
-        task, inputs, outputs = self.parse_signature_input(response, data)
-        h = hashlib.sha1()
+        return self._generate_signature(
+            self._get_signature_prefix(secret), response, data
+        )
+
+    def _get_signature_prefix(self, secret=""):
+        """
+        Hash of the secret and the task, which starts every signature
+        """
         my_secret = os.environ.get("MY_SECRET", secret)
-        h.update(my_secret.encode("utf-8"))
-        h.update(task.encode("utf-8"))
-        for key in sorted(inputs.keys()):
-            h.update(str(inputs[key]).encode("utf-8"))
-        for key in sorted(outputs.keys()):
-            h.update(str(outputs[key]).encode("utf-8"))
-        signature = h.hexdigest()
-        return signature
+        prefix = self._signature_prefixes.get(my_secret)
+        if prefix is None:
+            prefix = hashlib.sha1()
+            prefix.update(my_secret.encode("utf-8"))
+            prefix.update(self.plan.task.encode("utf-8"))
+            self._signature_prefixes[my_secret] = prefix
+        return prefix
+
+    def _generate_signature(self, prefix, response, data):
+        h = prefix.copy()
+        for values, names in (
+            (data, self.plan.signed_input_names),
+            (response, self.plan.signed_output_names),
+        ):
+            for name in names:
+                if name in values:
+                    value = values[name]
+                    if type(value) is not str:
+                        value = str(value)
+                    h.update(value.encode("utf-8"))
+        return h.hexdigest()
 
     def sign_response(self, response, data):
         response["signature"] = self.generate_response_signature(response, data)
 
+    def sign_responses(self, responses, data, secret=""):
+        """
+        Sign a batch of responses, data being the list of data they answer
+        """
+        prefix = self._get_signature_prefix(secret)
+        for response, datum in zip(responses, data):
+            response["signature"] = self._generate_signature(prefix, response, datum)
+
     def verify_response(self, response, data):
         """
         Defines task output by verifying a response satisfies all requirements
@@ -304,54 +607,97 @@ class TaskIO:
         assert "id" in response and response["id"] == data["uid"]
         assert response["signature"] == self.generate_response_signature(response, data)
 
+        plan = self.plan
         missing_target_fields = len(self.targets)
         extra_fields = len(response) - 2
 
-        target_names = [target["name"] for target in self.targets]
-
-        outputs = TaskIO.get_full_output_annotation_config_objs(
-            self.task_info["config"])
-        name_to_config_obj = {}
-        for output in outputs:
-            name_to_config_obj[output["name"]] = output
-
-        for output in outputs:
-            output_name = output["name"]
+        for output_name, verifier, output in plan.output_verifiers:
             if output_name in response:
                 extra_fields -= 1
-                if output_name in target_names:
+                if output_name in plan.target_names:
                     missing_target_fields -= 1
 
-                annotation_verifiers[output["type"]](
-                    response[output_name],
-                    output_name,
-                    name_to_config_obj,
-                    data,
+                if verifier is None:
+                    raise KeyError(output["type"])
+                verifier(
+                    response[output_name], output_name, plan.name_to_config_obj, data
                 )
 
         assert missing_target_fields == 0
         assert extra_fields == 0
 
-    def parse_signature_input(self, response, data):
+    @staticmethod
+    def get_failure_reason(e):
         """
-        Return task code name, inputs and outputs used to generate signature
+        Describe why a verification failed, using the failing line of code
+        for the bare asserts of the verifiers
         """
+        frame = traceback.extract_tb(e.__traceback__)[-1]
+        message = str(e) or frame.line
+        return f"{type(e).__name__} in {frame.name}: {message}"
 
-        task = self.task_info["task"]
-
-        def add_annotations(annotations, container_obj, value_src):
-            for annotation in annotations:
-                name = annotation["name"]
-                if name in value_src:
-                    container_obj[name] = value_src[name]
+    def _verify_chunk(self, start, responses, data):
+        failures = []
+        for i, (response, datum) in enumerate(zip(responses, data)):
+            try:
+                if isinstance(response, str):
+                    response = json.loads(response)
+                self.verify_response(response, datum)
+            except Exception as e:
+                failures.append((start + i, TaskIO.get_failure_reason(e)))
+        return failures
 
-        inputs, outputs = dict(), dict()
+    def verify_responses(self, responses, data, num_workers=None, chunk_size=1024):
+        """
+        Verify a list of responses against the list of data they answer, in
+        chunks of chunk_size responses spread over num_workers processes
+        (all the cpus by default). Unlike verify_response, this does not stop
+        at the first failure: it returns the list of (index, reason) of all
+        the responses that failed.
+        """
+        if len(responses) != len(data):
+            raise RuntimeError(
+                f"Got {len(responses)} responses for {len(data)} data points"
+            )
+        num_workers = num_workers or os.cpu_count() or 1
+        chunks = [
+            (
+                start,
+                responses[start : start + chunk_size],
+                data[start : start + chunk_size],
+            )
+            for start in range(0, len(responses), chunk_size)
+        ]
 
-        add_annotations(self.inputs_without_targets, inputs, data)
-        add_annotations(self.task_info["config"].get("context", []), inputs, data)
-        add_annotations(
-            TaskIO.get_full_output_annotation_config_objs(self.task_info["config"]),
-            outputs, response,
+        start_time = time.perf_counter()
+        if num_workers == 1 or len(chunks) <= 1:
+            results = [self._verify_chunk(*chunk) for chunk in chunks]
+        else:
+            with multiprocessing.Pool(
+                min(num_workers, len(chunks)),
+                initializer=_init_verify_worker,
+                initargs=(self,),
+            ) as pool:
+                results = pool.map(_verify_chunk, chunks)
+        elapsed = time.perf_counter() - start_time
+
+        failures = [failure for result in results for failure in result]
+        print(
+            f"Verified {len(responses)} responses in {elapsed:.2f}s "
+            f"({len(responses) / max(elapsed, 1e-9):.0f} responses/s), "
+            f"{len(failures)} failed"
         )
+        return failures
+
+    def parse_signature_input(self, response, data):
+        """
+        Return task code name, inputs and outputs used to generate signature
+        """
+
+        plan = self.plan
+        inputs = {name: data[name] for name in plan.input_names if name in data}
+        outputs = {
+            name: response[name] for name in plan.output_names if name in response
+        }
 
-        return task, inputs, outputs
+        return plan.task, inputs, outputs
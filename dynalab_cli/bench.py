@@ -0,0 +1,194 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import time
+
+from dynalab.handler.metrics import PERCENTILES, percentile
+from dynalab.tasks.task_io import TaskIO
+from dynalab_cli.test import TestCommand
+from dynalab_cli.utils import (
+    SetupConfigHandler,
+    get_peak_rss,
+    load_handler_module,
+    reset_peak_rss,
+)
+
+
+PROTOCOLS = ("single", "batched")
+
+
+def make_requests(examples, protocol):
+    """
+    Build the torchserve requests of one handle call: one request per
+    example for the single protocol, or one request of newline delimited
+    json examples for the batched protocol, like mock_handle_with_batching
+    """
+    if protocol == "single":
+        return [{"body": example} for example in examples]
+    body = "\n".join(json.dumps(example, ensure_ascii=False) for example in examples)
+    return [{"body": body}]
+
+
+def read_responses(outputs, protocol):
+    if protocol == "single":
+        return [
+            json.loads(output) if isinstance(output, str) else output
+            for output in outputs
+        ]
+    # not splitlines, which also splits on characters json leaves unescaped
+    return [json.loads(line) for line in outputs[0].split("\n") if line.strip()]
+
+
+class BenchCommand(TestCommand):
+    @staticmethod
+    def add_args(parser):
+        bench_parser = parser.add_parser(
+            "bench", help="Measure the throughput and latency of the handler locally"
+        )
+        bench_parser.add_argument(
+            "-n", "--name", type=str, required=True, help="Name of the model"
+        )
+        bench_parser.add_argument(
+            "--num-examples",
+            type=int,
+            default=256,
+            help="Number of examples sent for each batch size",
+        )
+        bench_parser.add_argument(
+            "--batch-sizes",
+            type=lambda s: [int(b) for b in s.split(",")],
+            default=[1, 4, 16, 64],
+            help="Comma separated numbers of examples per handle call",
+        )
+        bench_parser.add_argument(
+            "--protocol",
+            choices=PROTOCOLS + ("both",),
+            default="both",
+            help="Send one request per example (single), newline delimited json "
+            "requests of several examples (batched) or both",
+        )
+        bench_parser.add_argument(
+            "--warmup",
+            type=int,
+            default=2,
+            help="Number of untimed handle calls before each measurement",
+        )
+        bench_parser.add_argument(
+            "--seed", type=int, default=0, help="Seed of the generated examples"
+        )
+        bench_parser.add_argument(
+            "--output",
+            type=str,
+            default=None,
+            help="Where to save the results as json, defaults to "
+            ".dynalab/<name>/bench.json",
+        )
+
+    def __init__(self, args):
+        assert args.num_examples > 0, "--num-examples must be positive"
+        assert all(b > 0 for b in args.batch_sizes), "batch sizes must be positive"
+        self.args = args
+        self.config_handler = SetupConfigHandler(args.name)
+
+    def bench(self, task_io, handler, context, examples, protocol, batch_size):
+        batches = [
+            examples[i : i + batch_size] for i in range(0, len(examples), batch_size)
+        ]
+        for i in range(self.args.warmup):
+            handler.handle(make_requests(batches[i % len(batches)], protocol), context)
+
+        reset_peak_rss()
+        latencies, num_failures = [], 0
+        for batch in batches:
+            batch_requests = make_requests(batch, protocol)
+            start = time.perf_counter()
+            outputs = handler.handle(batch_requests, context)
+            latencies.append((time.perf_counter() - start) * 1000)
+            try:
+                responses = read_responses(outputs, protocol)
+            except Exception:
+                responses = []
+            if len(responses) != len(batch):
+                # the responses cannot be matched to their examples
+                num_failures += len(batch)
+                continue
+            for response, data in zip(responses, batch):
+                try:
+                    task_io.verify_response(response, data)
+                except Exception:
+                    num_failures += 1
+        peak_rss = get_peak_rss()
+
+        duration = sum(latencies) / 1000
+        num_requests = len(examples) if protocol == "single" else len(batches)
+        result = {
+            "protocol": protocol,
+            "batch_size": batch_size,
+            "num_examples": len(examples),
+            "qps": num_requests / duration,
+            "examples_per_sec": len(examples) / duration,
+            "peak_rss": peak_rss,
+            "num_failures": num_failures,
+        }
+        latencies.sort()
+        for p in PERCENTILES:
+            result[f"p{p}_ms"] = percentile(latencies, p)
+        return result
+
+    def print_report(self, results):
+        header = (
+            f"{'protocol':>8} {'batch':>6} {'qps':>10} {'examples/s':>11} "
+            + " ".join(f"{f'p{p} (ms)':>10}" for p in PERCENTILES)
+            + f" {'peak rss (MB)':>14} {'failures':>9}"
+        )
+        print(header)
+        print("-" * len(header))
+        for result in results:
+            print(
+                f"{result['protocol']:>8} {result['batch_size']:>6} "
+                f"{result['qps']:>10.2f} {result['examples_per_sec']:>11.2f} "
+                + " ".join(f"{result[f'p{p}_ms']:>10.2f}" for p in PERCENTILES)
+                + f" {result['peak_rss'] / 2 ** 20:>14.0f}"
+                f" {result['num_failures']:>9}"
+            )
+
+    def run_command(self):
+        config = self.config_handler.load_config()
+        # load the handler and taskIO like the local test
+        handler = load_handler_module(config["handler"])
+        task_io = TaskIO(config["task"])
+        use_gpu = self.use_gpu(config)
+        context = task_io._get_mock_torchserve_context(self.args.name, use_gpu)
+        start = time.perf_counter()
+        handler.handle(None, context)
+        initialize_s = time.perf_counter() - start
+        print(f"Handler initialized in {initialize_s:.2f} s")
+
+        examples = list(
+            task_io.generate_mock_data(self.args.num_examples, seed=self.args.seed)
+        )
+        protocols = PROTOCOLS if self.args.protocol == "both" else [self.args.protocol]
+        results = []
+        for protocol in protocols:
+            for batch_size in self.args.batch_sizes:
+                print(f"Benchmarking the {protocol} protocol, batch size {batch_size}")
+                results.append(
+                    self.bench(
+                        task_io, handler, context, examples, protocol, batch_size
+                    )
+                )
+        print()
+        self.print_report(results)
+        if any(result["num_failures"] for result in results):
+            print("Warning: some responses fail verify_response")
+
+        output = self.args.output or os.path.join(
+            self.config_handler.config_dir, "bench.json"
+        )
+        with open(output, "w") as f:
+            json.dump({"initialize_s": initialize_s, "results": results}, f, indent=4)
+        print(f"Results saved at {output}")
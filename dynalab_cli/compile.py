@@ -0,0 +1,182 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import inspect
+import json
+import os
+
+from dynalab.tasks.task_io import TaskIO
+from dynalab_cli.test import TestCommand
+from dynalab_cli.utils import SetupConfigHandler, load_handler_module
+
+
+def flatten_tensors(output):
+    """
+    List the tensors of a model output, which can be a tensor or any nesting
+    of tuples, lists and dicts of tensors
+    """
+    import torch
+
+    if isinstance(output, torch.Tensor):
+        return [output]
+    if isinstance(output, dict):
+        return [t for key in sorted(output) for t in flatten_tensors(output[key])]
+    if isinstance(output, (list, tuple)):
+        return [t for item in output for t in flatten_tensors(item)]
+    return []
+
+
+class CompileCommand(TestCommand):
+    @staticmethod
+    def add_args(parser):
+        compile_parser = parser.add_parser(
+            "compile",
+            help="Compile the model of the handler with TorchScript for serving",
+        )
+        compile_parser.add_argument(
+            "-n", "--name", type=str, required=True, help="Name of the model"
+        )
+        compile_parser.add_argument(
+            "--rtol",
+            type=float,
+            default=1e-3,
+            help="Relative tolerance between the eager and compiled outputs",
+        )
+        compile_parser.add_argument(
+            "--atol",
+            type=float,
+            default=1e-4,
+            help="Absolute tolerance between the eager and compiled outputs",
+        )
+
+    def __init__(self, args):
+        self.args = args
+        self.config_handler = SetupConfigHandler(args.name)
+
+    def capture_model_inputs(self, service, examples_list):
+        """
+        Run each list of examples through preprocess and inference, and record
+        the arguments the handler passes to service.model
+        """
+        captured = []
+        forward = service.model.forward
+
+        def recording_forward(*args, **kwargs):
+            captured.append((args, kwargs))
+            return forward(*args, **kwargs)
+
+        service.model.forward = recording_forward
+        try:
+            for examples in examples_list:
+                service._infer_examples(examples)
+        finally:
+            del service.model.forward
+        return captured
+
+    def trace(self, model, args, kwargs, optimize=True):
+        """
+        Trace model on args or kwargs. With optimize, the traced model is
+        also frozen, which turns its weights into constants of the device it
+        was traced on.
+        """
+        import torch
+
+        if kwargs and args:
+            raise RuntimeError(
+                "Unable to trace a model called with both positional and "
+                "keyword arguments"
+            )
+        if kwargs:
+            trace_parameters = inspect.signature(torch.jit.trace).parameters
+            if "example_kwarg_inputs" not in trace_parameters:
+                raise RuntimeError(
+                    "Tracing a model called with keyword arguments needs torch>=2.0"
+                )
+            traced = torch.jit.trace(model, example_kwarg_inputs=kwargs, strict=False)
+        else:
+            traced = torch.jit.trace(model, args, strict=False)
+        if not optimize:
+            return traced
+        if hasattr(torch.jit, "optimize_for_inference"):
+            return torch.jit.optimize_for_inference(traced)
+        return torch.jit.freeze(traced)
+
+    def run_command(self):
+        import torch
+
+        config = self.config_handler.load_config()
+        task_io = TaskIO(config["task"])
+        handler = load_handler_module(config["handler"])
+        if not hasattr(handler, "_service"):
+            raise RuntimeError("No _service found in the handler")
+        service = handler._service
+        service.setup_config_overrides = {"compiled_model": None, "quantization": None}
+        context = TaskIO._get_mock_torchserve_context(self.args.name, False)
+        handler.handle(None, context)
+        if not isinstance(getattr(service, "model", None), torch.nn.Module):
+            raise RuntimeError(
+                "Compiling needs the handler to keep its model in self.model"
+            )
+        model = service.model.eval()
+
+        # trace on the whole batch, and check on each example too, since
+        # their shapes differ from the batch
+        mock_datapoints, _ = task_io.get_mock_data()
+        captured = self.capture_model_inputs(
+            service, [mock_datapoints] + [[data] for data in mock_datapoints]
+        )
+        print("Tracing the model with TorchScript...")
+        # the model is traced on cpu, freezing it would keep its weights on cpu
+        # after the handler moves it to the gpu
+        optimize = not self.use_gpu(config)
+        if not optimize:
+            print("Skipping the cpu optimizations, since the model runs on gpu")
+        with torch.no_grad():
+            compiled = self.trace(model, *captured[0], optimize=optimize)
+
+            print("Comparing compiled and eager outputs...")
+            for i, (args, kwargs) in enumerate(captured):
+                eager_outputs = flatten_tensors(model(*args, **kwargs))
+                compiled_outputs = flatten_tensors(compiled(*args, **kwargs))
+                assert len(eager_outputs) == len(compiled_outputs), (
+                    f"The compiled model returns {len(compiled_outputs)} tensors "
+                    f"instead of {len(eager_outputs)}"
+                )
+                for eager, traced in zip(eager_outputs, compiled_outputs):
+                    if not torch.allclose(
+                        eager, traced, rtol=self.args.rtol, atol=self.args.atol
+                    ):
+                        diff = (eager - traced).abs().max().item()
+                        raise RuntimeError(
+                            f"Compiled outputs differ from eager outputs on input "
+                            f"{i + 1} / {len(captured)}: max difference {diff}"
+                        )
+
+        # the handler must work as is with the compiled model
+        print("Checking the handler responses with the compiled model...")
+        service.model = compiled
+        try:
+            for data in mock_datapoints:
+                response = handler.handle([{"body": data}], context)[0]
+                if isinstance(response, str):
+                    response = json.loads(response)
+                task_io.verify_response(response, data)
+        except Exception as e:
+            raise RuntimeError(
+                f"The handler fails with the compiled model: {e}. The outputs "
+                "of a traced model are tuples or dicts of tensors, you may need "
+                "to adapt inference to them."
+            )
+
+        compiled_path = os.path.normpath(
+            os.path.join(self.config_handler.config_dir, "compiled_model.pt")
+        )
+        torch.jit.save(compiled, compiled_path)
+        config["compiled_model"] = compiled_path
+        self.config_handler.write_config(config)
+        print(
+            f"Compiled model saved at {compiled_path} and added to the config. "
+            "It will be used in place of the eager model."
+        )
@@ -5,7 +5,11 @@
 
 from argparse import ArgumentParser
 
+from dynalab_cli.bench import BenchCommand
+from dynalab_cli.compile import CompileCommand
 from dynalab_cli.init import InitCommand
+from dynalab_cli.replay import ReplayCommand
+from dynalab_cli.sweep import SweepCommand
 from dynalab_cli.test import TestCommand
 from dynalab_cli.upload import UploadCommand
 from dynalab_cli.user import LoginCommand, LogoutCommand
@@ -16,6 +20,10 @@ command_map = {
     "logout": LogoutCommand,
     "init": InitCommand,
     "test": TestCommand,
+    "bench": BenchCommand,
+    "compile": CompileCommand,
+    "sweep": SweepCommand,
+    "replay": ReplayCommand,
     "upload": UploadCommand,
 }
 
@@ -28,6 +36,10 @@ def main():
     LogoutCommand.add_args(subparsers)
     InitCommand.add_args(subparsers)
     TestCommand.add_args(subparsers)
+    BenchCommand.add_args(subparsers)
+    CompileCommand.add_args(subparsers)
+    SweepCommand.add_args(subparsers)
+    ReplayCommand.add_args(subparsers)
     UploadCommand.add_args(subparsers)
 
     args = parser.parse_args()
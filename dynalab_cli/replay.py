@@ -0,0 +1,120 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+
+from dynalab.handler.metrics import PERCENTILES
+from dynalab.handler.traffic import http_sender, read_traffic, replay
+from dynalab.tasks.task_io import TaskIO
+from dynalab_cli.test import TestCommand
+from dynalab_cli.utils import SetupConfigHandler, load_handler_module
+
+
+class ReplayCommand(TestCommand):
+    @staticmethod
+    def add_args(parser):
+        replay_parser = parser.add_parser(
+            "replay",
+            help="Replay recorded traffic against the handler or a torchserve endpoint",
+        )
+        replay_parser.add_argument(
+            "-n", "--name", type=str, required=True, help="Name of the model"
+        )
+        replay_parser.add_argument(
+            "traffic",
+            type=str,
+            nargs="+",
+            help="Traffic files recorded by enable_traffic_recording, or their "
+            "directories",
+        )
+        replay_parser.add_argument(
+            "--endpoint",
+            type=str,
+            default=None,
+            help="Send the requests to the torchserve inference API at this url "
+            "(e.g. http://localhost:8080) instead of calling the handler directly",
+        )
+        speed_group = replay_parser.add_mutually_exclusive_group()
+        speed_group.add_argument(
+            "--speed",
+            type=float,
+            default=1.0,
+            help="Replay speed, e.g. 2 halves the time between two requests",
+        )
+        speed_group.add_argument(
+            "--max-speed",
+            action="store_true",
+            help="Send the requests as fast as possible, ignoring their timestamps",
+        )
+        replay_parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="Maximum number of requests in flight",
+        )
+        replay_parser.add_argument(
+            "--output", type=str, default=None, help="Save the results as json here"
+        )
+
+    def __init__(self, args):
+        assert args.concurrency > 0, "--concurrency must be positive"
+        self.args = args
+        self.config_handler = SetupConfigHandler(args.name)
+
+    def get_handler_sender(self):
+        config = self.config_handler.load_config()
+        handler = load_handler_module(config["handler"])
+        context = TaskIO._get_mock_torchserve_context(
+            self.args.name, self.use_gpu(config)
+        )
+        # initialize outside of the replay
+        handler.handle(None, context)
+
+        def send(body):
+            return handler.handle([{"body": body}], context)[0]
+
+        return send
+
+    def run_command(self):
+        if self.args.endpoint:
+            send = http_sender(
+                f"{self.args.endpoint.rstrip('/')}/predictions/{self.args.name}"
+            )
+            target = self.args.endpoint
+        else:
+            send = self.get_handler_sender()
+            target = "the handler"
+        speed = None if self.args.max_speed else self.args.speed
+        print(
+            f"Replaying {', '.join(self.args.traffic)} against {target} at "
+            + ("max speed" if speed is None else f"{speed}x speed")
+            + "..."
+        )
+        stats = replay(
+            read_traffic(self.args.traffic),
+            send,
+            speed=speed,
+            concurrency=self.args.concurrency,
+        )
+
+        print(
+            f"{stats['num_requests']} requests in {stats['duration']:.2f} s "
+            f"({stats['qps']:.2f} qps), {stats['num_errors']} errors"
+        )
+        print(
+            "Latency: "
+            + ", ".join(f"p{p} {stats[f'p{p}_ms']:.2f} ms" for p in PERCENTILES)
+        )
+        if speed is not None:
+            print(
+                "Maximum delay behind the original schedule: "
+                f"{stats['max_lag_ms']:.0f} ms"
+            )
+        for error in stats["errors"]:
+            print(f"Error: {error}")
+        if self.args.output:
+            with open(self.args.output, "w") as f:
+                json.dump(stats, f, indent=4)
+            print(f"Results saved at {self.args.output}")
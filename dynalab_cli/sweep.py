@@ -0,0 +1,325 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import base64
+import json
+import math
+import statistics
+import struct
+import time
+
+from dynalab.tasks.annotation_types import AnnotationTypeEnum
+from dynalab.tasks.task_io import TaskIO
+from dynalab_cli.test import CONTAINER_CPUS, CONTAINER_MEMORY, TestCommand
+from dynalab_cli.utils import (
+    SetupConfigHandler,
+    get_peak_rss,
+    load_handler_module,
+    reset_peak_rss,
+)
+
+
+# torchserve starts one worker per cpu, which share the memory of the container
+WORKER_MEMORY = CONTAINER_MEMORY // CONTAINER_CPUS
+
+
+def geometric_sizes(min_size, max_size, factor=2):
+    sizes = []
+    size = min_size
+    while size <= max_size:
+        sizes.append(size)
+        size = max(int(size * factor), size + 1)
+    return sizes
+
+
+def get_scaling_exponents(points):
+    """
+    Local exponent k of latency ~ amount^k between consecutive points, e.g. 1
+    when the latency grows linearly with the input size and 2 quadratically
+    """
+    exponents = [None]
+    for previous, point in zip(points, points[1:]):
+        if min(previous["latency_ms"], point["latency_ms"]) <= 0:
+            exponents.append(None)
+            continue
+        exponents.append(
+            math.log(point["latency_ms"] / previous["latency_ms"])
+            / math.log(point["amount"] / previous["amount"])
+        )
+    return exponents
+
+
+def find_knee(points):
+    """
+    Index of the knee of the latency curve, i.e. the point furthest below the
+    chord between the first and last points in log-log scale, after which
+    the latency grows fastest. None if the curve has no knee.
+    """
+    if len(points) < 3:
+        return None
+    xs = [math.log(point["amount"]) for point in points]
+    ys = [math.log(max(point["latency_ms"], 1e-6)) for point in points]
+    if ys[-1] <= ys[0]:
+        return None
+    # normalize both axes to [0, 1], the chord is then y = x
+    distances = [
+        (x - xs[0]) / (xs[-1] - xs[0]) - (y - ys[0]) / (ys[-1] - ys[0])
+        for x, y in zip(xs, ys)
+    ]
+    knee = max(range(len(points)), key=lambda i: distances[i])
+    return knee if distances[knee] > 0 else None
+
+
+class SweepCommand(TestCommand):
+    @staticmethod
+    def add_args(parser):
+        sweep_parser = parser.add_parser(
+            "sweep",
+            help="Measure the latency and memory of the handler on growing inputs",
+        )
+        sweep_parser.add_argument(
+            "-n", "--name", type=str, required=True, help="Name of the model"
+        )
+        sweep_parser.add_argument(
+            "--min-string-length",
+            type=int,
+            default=16,
+            help="Number of words of the shortest string input",
+        )
+        sweep_parser.add_argument(
+            "--max-string-length",
+            type=int,
+            default=16384,
+            help="Number of words of the longest string input",
+        )
+        sweep_parser.add_argument(
+            "--min-image-size",
+            type=int,
+            default=64,
+            help="Width and height in pixels of the smallest image input",
+        )
+        sweep_parser.add_argument(
+            "--max-image-size",
+            type=int,
+            default=4096,
+            help="Width and height in pixels of the largest image input",
+        )
+        sweep_parser.add_argument(
+            "--factor", type=float, default=2, help="Growth factor between two sizes"
+        )
+        sweep_parser.add_argument(
+            "--repeats",
+            type=int,
+            default=3,
+            help="Number of requests timed at each size, the median is reported",
+        )
+        sweep_parser.add_argument(
+            "--output", type=str, default=None, help="Save the results as json here"
+        )
+
+    def __init__(self, args):
+        assert args.factor > 1, "--factor must be greater than 1"
+        assert args.repeats > 0, "--repeats must be positive"
+        self.args = args
+        self.config_handler = SetupConfigHandler(args.name)
+
+    def get_sizes(self, annotation_type):
+        """
+        Return the sizes to sweep for an annotation type, as (size, amount,
+        options) with amount the number of words or pixels of the input and
+        options the generate_mock_data options of the annotation
+        """
+        if annotation_type == AnnotationTypeEnum.string.value:
+            return [
+                (size, size, {"string_length": lambda rng, size=size: size})
+                for size in geometric_sizes(
+                    self.args.min_string_length,
+                    self.args.max_string_length,
+                    self.args.factor,
+                )
+            ]
+        if annotation_type == AnnotationTypeEnum.image.value:
+            return [
+                (
+                    f"{size}x{size}",
+                    size * size,
+                    {"image_size": lambda rng, size=size: (size, size)},
+                )
+                for size in geometric_sizes(
+                    self.args.min_image_size,
+                    self.args.max_image_size,
+                    self.args.factor,
+                )
+            ]
+        return []
+
+    def get_fixed_options(self, task_io, annotations):
+        """
+        Options keeping each string and image annotation at the size it has
+        in the first data point of seed 0, so that only the swept annotation
+        changes from one size to the next
+        """
+        datum = next(task_io.generate_mock_data(1, seed=0))
+        options = dict()
+        for annotation in annotations:
+            value = datum[annotation["name"]]
+            if annotation["type"] == AnnotationTypeEnum.string.value:
+                length = len(value.split(" "))
+                options[annotation["name"]] = {
+                    "string_length": lambda rng, length=length: length
+                }
+            elif annotation["type"] == AnnotationTypeEnum.image.value:
+                # width and height from the IHDR chunk of the png
+                size = struct.unpack(">II", base64.b64decode(value)[16:24])
+                options[annotation["name"]] = {
+                    "image_size": lambda rng, size=size: size
+                }
+        return options
+
+    def measure(self, task_io, handler, context, data, use_gpu):
+        """
+        Time args.repeats requests of data, returning the median latency, the
+        peak memory of the process during the requests and whether the
+        responses pass verify_response
+        """
+        import torch
+
+        reset_peak_rss()
+        if use_gpu:
+            torch.cuda.reset_peak_memory_stats()
+        latencies = []
+        passed = True
+        for _ in range(self.args.repeats):
+            start = time.perf_counter()
+            response = handler.handle([{"body": data}], context)[0]
+            latencies.append((time.perf_counter() - start) * 1000)
+            if isinstance(response, str):
+                response = json.loads(response)
+            try:
+                task_io.verify_response(response, data)
+            except AssertionError:
+                passed = False
+        result = {
+            "latency_ms": statistics.median(latencies),
+            "peak_rss": get_peak_rss(),
+            "passed": passed,
+        }
+        if use_gpu:
+            result["peak_gpu_memory"] = torch.cuda.max_memory_allocated()
+        return result
+
+    def sweep_annotation(
+        self, task_io, handler, context, annotation, fixed_options, use_gpu
+    ):
+        points = []
+        for size, amount, annotation_options in self.get_sizes(annotation["type"]):
+            options = {
+                "annotation_options": dict(
+                    fixed_options, **{annotation["name"]: annotation_options}
+                )
+            }
+            data = next(task_io.generate_mock_data(1, seed=0, options=options))
+            point = {"size": size, "amount": amount}
+            try:
+                point.update(self.measure(task_io, handler, context, data, use_gpu))
+            except Exception as e:
+                # e.g. out of memory, or longer than the model supports
+                point["error"] = repr(e)
+                points.append(point)
+                break
+            point["over_budget"] = point["peak_rss"] > WORKER_MEMORY
+            points.append(point)
+            print(
+                f"{annotation['name']} {size}: {point['latency_ms']:.2f} ms, "
+                f"peak rss {point['peak_rss'] / 2 ** 20:.0f} MB"
+            )
+            if point["over_budget"]:
+                # larger inputs can only need more memory
+                break
+
+        measured = [point for point in points if "error" not in point]
+        for point, exponent in zip(measured, get_scaling_exponents(measured)):
+            point["scaling_exponent"] = exponent
+        knee = find_knee(measured)
+        return {
+            "name": annotation["name"],
+            "type": annotation["type"],
+            "points": points,
+            "knee": None if knee is None else measured[knee]["size"],
+        }
+
+    def print_report(self, results):
+        budget_gb = WORKER_MEMORY / 2 ** 30
+        for result in results:
+            print(f"\n{result['name']} ({result['type']}):")
+            print(
+                f"{'size':>12} {'latency (ms)':>14} {'scaling':>8} "
+                f"{'peak rss (MB)':>14}"
+            )
+            for point in result["points"]:
+                if "error" in point:
+                    print(f"{point['size']:>12} failed: {point['error']}")
+                    continue
+                exponent = point["scaling_exponent"]
+                exponent = "" if exponent is None else f"{exponent:.2f}"
+                flags = []
+                if point["size"] == result["knee"]:
+                    flags.append("<- knee")
+                if point["over_budget"]:
+                    flags.append(f"over the {budget_gb:.0f}GB worker budget")
+                if not point["passed"]:
+                    flags.append("fails verify_response")
+                print(
+                    f"{point['size']:>12} {point['latency_ms']:>14.2f} "
+                    f"{exponent:>8} {point['peak_rss'] / 2 ** 20:>14.0f} "
+                    + " ".join(flags)
+                )
+            if result["knee"] is not None:
+                print(
+                    f"Latency grows fastest past {result['knee']} for "
+                    f"{result['name']}"
+                )
+            over_budget = [
+                point["size"] for point in result["points"] if point.get("over_budget")
+            ]
+            if over_budget:
+                print(
+                    f"Warning: the handler exceeds the {budget_gb:.0f}GB budget of "
+                    f"each of the {CONTAINER_CPUS} workers of the container from "
+                    f"{result['name']} of size {over_budget[0]}"
+                )
+
+    def run_command(self):
+        config = self.config_handler.load_config()
+        task_io = TaskIO(config["task"])
+        handler = load_handler_module(config["handler"])
+        use_gpu = self.use_gpu(config)
+        context = task_io._get_mock_torchserve_context(self.args.name, use_gpu)
+        # initialize outside of the measurements
+        handler.handle(None, context)
+
+        annotations = task_io.inputs_without_targets + task_io.task_info[
+            "config"
+        ].get("context", [])
+        fixed_options = self.get_fixed_options(task_io, annotations)
+        results = []
+        for annotation in annotations:
+            if not self.get_sizes(annotation["type"]):
+                continue
+            print(f"Sweeping the size of {annotation['name']}...")
+            results.append(
+                self.sweep_annotation(
+                    task_io, handler, context, annotation, fixed_options, use_gpu
+                )
+            )
+        if not results:
+            print("The task has no string or image input to sweep")
+            return
+
+        self.print_report(results)
+        if self.args.output:
+            with open(self.args.output, "w") as f:
+                json.dump(results, f, indent=4)
+            print(f"Results saved at {self.args.output}")
@@ -3,21 +3,74 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import argparse
 import importlib
+import json
 import logging
+import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
+import time
+import tracemalloc
 from pathlib import Path
 
 from dynalab_cli import BaseCommand
-from dynalab_cli.utils import SetupConfigHandler
+from dynalab_cli.utils import (
+    SetupConfigHandler,
+    check_performance_budget,
+    get_model_names,
+    get_peak_rss,
+    get_rss,
+    load_handler_module,
+    parse_metrics,
+    reset_peak_rss,
+)
 
 
 logger = logging.getLogger(__name__)
 
 MAX_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
+# NOTE: cpu and memory limit are specific to ml.m5.xlarge
+CONTAINER_CPUS = 4
+CONTAINER_MEMORY = 16 * 1024 * 1024 * 1024  # 16GB
+
+
+def _run_model_local_test(job):
+    """
+    Run the local test of one model in a pool process, with its output sent
+    to .dynalab/<name>/tmp/local_test.log
+    """
+    args, name, jobs = job
+    args = argparse.Namespace(**dict(args, name=[name], all=False))
+    # the thread policy of the handler then splits the cpus between the tests
+    # running in parallel, as it does between torchserve workers
+    os.environ["TS_DEFAULT_WORKERS_PER_MODEL"] = str(jobs)
+    log_dir = os.path.join(SetupConfigHandler(name).config_dir, "tmp")
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, "local_test.log")
+
+    result = {"name": name, "passed": False, "error": None, "log": log_path}
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # redirect the file descriptors to catch the output of libraries too
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            TestCommand(args).run_command()
+            result["passed"] = True
+        except SystemExit:
+            result["error"] = "Invalid config file, see the log"
+        except Exception as e:
+            result["error"] = str(e)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+    result["duration"] = time.perf_counter() - start
+    return result
 
 
 class TestCommand(BaseCommand):
@@ -26,16 +79,47 @@ class TestCommand(BaseCommand):
         test_parser = parser.add_parser(
             "test", help="Check files and test code in local environment"
         )
-        test_parser.add_argument(
-            "-n", "--name", type=str, required=True, help="Name of the model"
+        names_group = test_parser.add_mutually_exclusive_group(required=True)
+        names_group.add_argument(
+            "-n",
+            "--name",
+            type=str,
+            nargs="+",
+            help="Name of the model, or names of several models to test locally",
+        )
+        names_group.add_argument(
+            "--all",
+            action="store_true",
+            help="Test all the models of the project locally",
         )
         test_parser.add_argument(
             "--local", action="store_true", help="whether to run local test only"
         )
+        test_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            help="Number of models tested in parallel when testing several models, "
+            "at most 4 by default",
+        )
+        test_parser.add_argument(
+            "--profile-memory",
+            action="store_true",
+            help="Report the memory used by initialize and handle in the local test, "
+            "and project it to the workers of the container",
+        )
 
     def __init__(self, args):
         self.args = args
-        self.config_handler = SetupConfigHandler(args.name)
+        self.names = get_model_names() if args.all else args.name
+        if len(self.names) == 1:
+            self.args.name = self.names[0]
+            self.config_handler = SetupConfigHandler(self.args.name)
+        else:
+            for name in self.names:
+                SetupConfigHandler(name)
+            self.config_handler = None
 
     def use_gpu(self, config) -> bool:
         task = config["task"]
@@ -54,6 +138,10 @@ class TestCommand(BaseCommand):
         return should_use_gpu
 
     def run_command(self):
+        if self.config_handler is None:
+            self.run_local_tests()
+            return
+
         # Validate config file: all keys exist, required values specified,
         # all specified files exist, handler files in the same directory as handler,
         # and handler file inherits from the correct base handler
@@ -87,6 +175,53 @@ class TestCommand(BaseCommand):
         else:
             self.run_docker_test(config)
 
+    def run_local_tests(self):
+        """
+        Run the local test of each model of self.names in its own process, at
+        most args.jobs at a time, and print a summary
+        """
+        if not self.names:
+            print("Error: No model found, please create one by dynalab-cli init")
+            exit(1)
+        if not self.args.local:
+            print("Error: Several models can only be tested locally, with --local")
+            exit(1)
+        jobs = self.args.jobs or min(len(self.names), os.cpu_count() or 1, 4)
+        print(f"Testing {len(self.names)} models locally, {jobs} at a time...")
+
+        start = time.perf_counter()
+        # each test gets a new interpreter, so that the handler modules and
+        # the sys.path they need do not leak from one model to the next
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(jobs, maxtasksperchild=1) as pool:
+            results = []
+            for result in pool.imap(
+                _run_model_local_test,
+                [(vars(self.args), name, jobs) for name in self.names],
+            ):
+                status = "passed" if result["passed"] else "FAILED"
+                print(f"{result['name']}: {status} in {result['duration']:.2f} s")
+                results.append(result)
+        duration = time.perf_counter() - start
+
+        print("\nSummary:")
+        width = max(len(name) for name in self.names)
+        for result in results:
+            status = "passed" if result["passed"] else "FAILED"
+            print(
+                f"    {result['name']:<{width}} {status:<6} "
+                f"{result['duration']:>8.2f} s   log: {result['log']}"
+            )
+            if result["error"]:
+                print(f"    {'':<{width}} {result['error']}")
+        num_passed = sum(result["passed"] for result in results)
+        print(
+            f"{num_passed} / {len(results)} models passed the local test "
+            f"in {duration:.2f} s"
+        )
+        if num_passed < len(results):
+            exit(1)
+
     def run_docker_test(self, config):
         tmp_dir = os.path.join(self.config_handler.config_dir, "tmp")
         os.makedirs(tmp_dir, exist_ok=True)
@@ -129,8 +264,11 @@ class TestCommand(BaseCommand):
             "--export-path",
             tmp_dir,
         ]
-        if config["model_files"]:
-            archive_command += ["--extra-files", ",".join(config["model_files"])]
+        extra_files = list(config["model_files"] or [])
+        if config.get("compiled_model"):
+            extra_files.append(config["compiled_model"])
+        if extra_files:
+            archive_command += ["--extra-files", ",".join(extra_files)]
         process = subprocess.run(
             archive_command,
             stdout=subprocess.PIPE,
@@ -196,13 +334,12 @@ class TestCommand(BaseCommand):
         ] + docker_build_args
 
         subprocess.run(docker_build_command)
-        # NOTE: cpu and memory limit are specific to ml.m5.xlarge
         docker_run = [
             "docker",
             "run",
             "--network=none",
-            "--cpus=4",
-            "--memory=16G",
+            f"--cpus={CONTAINER_CPUS}",
+            f"--memory={CONTAINER_MEMORY // (1024 * 1024 * 1024)}G",
             repository_name,
         ]
         if use_gpu:
@@ -219,6 +356,11 @@ class TestCommand(BaseCommand):
             f.write(process.stderr)
         with open(os.path.join(tmp_dir, "ts_log.out"), "w") as f:
             f.write(process.stdout)
+        metrics = parse_metrics(process.stdout)
+        with open(os.path.join(tmp_dir, "metrics.json"), "w") as f:
+            json.dump(metrics, f, indent=4)
+        if "startup_s" in metrics:
+            print(f"Model started serving in {metrics['startup_s']:.2f} s")
 
         if process.returncode != 0:
             raise RuntimeError(
@@ -226,6 +368,7 @@ class TestCommand(BaseCommand):
                 f"{ts_log} for detailed torchserve log."
             )
         else:
+            self.check_performance(config, metrics)
             print(
                 f"Integrated test passed. " f"Torchserve log can be found at {ts_log}"
             )
@@ -242,19 +385,39 @@ class TestCommand(BaseCommand):
         )
         subprocess.run(f"docker system prune", shell=True)
 
+    def check_performance(self, config, metrics):
+        """
+        Report the performance measured in the docker, and fail if it exceeds
+        the performance budget of the config. Any error of the load test fails
+        unless the budget sets max_error_rate.
+        """
+        if metrics:
+            print("Performance measured in the docker:")
+            for name, value in metrics.items():
+                print(f"    {name}: {value:.2f}")
+        budget = dict(config.get("performance_budget") or dict())
+        if "error_rate" in metrics:
+            budget.setdefault("max_error_rate", 0.0)
+        if not budget:
+            return
+        violations = check_performance_budget(budget, metrics)
+        if violations:
+            raise RuntimeError(
+                "Integrated test failed, the model exceeds its performance budget:\n"
+                + "\n".join(f"    {violation}" for violation in violations)
+            )
+        print("Performance budget met.")
+
     def run_local_test(self, config):
         # load handler
-        sys.path.append(os.getcwd())
-        handler_spec = importlib.util.spec_from_file_location(
-            "handler", config["handler"]
-        )
-        handler = importlib.util.module_from_spec(handler_spec)
-        handler_spec.loader.exec_module(handler)
+        handler = load_handler_module(config["handler"])
 
         # load taskIO
         task_io = importlib.import_module(f"dynalab.tasks.task_io").TaskIO(
             config["task"]
         )
+        if self.args.profile_memory:
+            self.profile_memory(config, task_io, handler)
         try:
             task_io.mock_handle_individually(
                 self.args.name, self.use_gpu(config), handler.handle
@@ -263,3 +426,161 @@ class TestCommand(BaseCommand):
             raise RuntimeError(f"Local test failed because of: {e}")
         else:
             print("Local test passed")
+
+        if config.get("quantization"):
+            self.compare_quantization(config, task_io, handler)
+
+    def time_mock_data(self, task_io, handler, use_gpu, num_rounds):
+        """
+        Run the mock data through handler num_rounds times, returning the
+        average latency per example and whether all responses were verified
+        """
+        context = task_io._get_mock_torchserve_context(self.args.name, use_gpu)
+        mock_datapoints, _ = task_io.get_mock_data()
+        # initialize outside of the timed loop
+        handler.handle(None, context)
+        passed = True
+        start = time.perf_counter()
+        for _ in range(num_rounds):
+            for data in mock_datapoints:
+                response = handler.handle([{"body": data}], context)[0]
+                if isinstance(response, str):
+                    response = json.loads(response)
+                try:
+                    task_io.verify_response(response, data)
+                except AssertionError:
+                    passed = False
+        latency = (time.perf_counter() - start) / (num_rounds * len(mock_datapoints))
+        return latency * 1000, passed
+
+    def compare_quantization(self, config, task_io, quantized_handler, num_rounds=10):
+        """
+        Compare the model quantized according to the config with the fp32 model
+        """
+        if not hasattr(quantized_handler, "_service"):
+            print("No _service found in the handler, skipping quantization report")
+            return
+        print(f"Comparing the {config['quantization']} model to the fp32 model...")
+        fp32_handler = load_handler_module(config["handler"])
+        fp32_handler._service.setup_config_overrides = {"quantization": None}
+
+        use_gpu = self.use_gpu(config)
+        fp32_ms, fp32_passed = self.time_mock_data(
+            task_io, fp32_handler, use_gpu, num_rounds
+        )
+        quantized_ms, quantized_passed = self.time_mock_data(
+            task_io, quantized_handler, use_gpu, num_rounds
+        )
+        print(f"fp32: {fp32_ms:.2f} ms per example")
+        print(
+            f"{config['quantization']}: {quantized_ms:.2f} ms per example, "
+            f"{fp32_ms / quantized_ms:.2f}x speedup"
+        )
+        for precision, passed in (
+            ("fp32", fp32_passed),
+            (config["quantization"], quantized_passed),
+        ):
+            status = "pass" if passed else "fail"
+            print(f"Responses of the {precision} model {status} verify_response")
+
+    def measure_memory(self, func, use_gpu):
+        """
+        Run func, and return the resident memory before and after it, its
+        peak resident memory, the peak of its python allocations traced by
+        tracemalloc and, on gpu, the peak of the torch cuda allocator
+        """
+        import torch
+
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()
+        python_before, _ = tracemalloc.get_traced_memory()
+        if use_gpu:
+            torch.cuda.reset_peak_memory_stats()
+        reset_peak_rss()
+        rss_before = get_rss()
+        func()
+        stats = {
+            "rss_before": rss_before,
+            "rss": get_rss(),
+            "peak_rss": get_peak_rss(),
+            "python_peak": tracemalloc.get_traced_memory()[1] - python_before,
+        }
+        if use_gpu:
+            stats["cuda_peak"] = torch.cuda.max_memory_allocated()
+            stats["cuda_reserved"] = torch.cuda.memory_reserved()
+        return stats
+
+    def profile_memory(self, config, task_io, handler):
+        """
+        Report the memory used by initialize and by each request of the mock
+        data, and warn if the workers of the container would not fit in its
+        memory
+        """
+        import torch
+
+        mb = 1024 * 1024
+        use_gpu = self.use_gpu(config)
+        context = task_io._get_mock_torchserve_context(self.args.name, use_gpu)
+        mock_datapoints, _ = task_io.get_mock_data()
+        print("Profiling memory...")
+        tracemalloc.start()
+        try:
+            initialize = self.measure_memory(
+                lambda: handler.handle(None, context), use_gpu
+            )
+            handle_stats = [
+                self.measure_memory(
+                    lambda: handler.handle([{"body": data}], context), use_gpu
+                )
+                for data in mock_datapoints
+            ]
+        finally:
+            tracemalloc.stop()
+
+        def describe(stats):
+            description = (
+                f"resident {stats['rss'] / mb:.0f} MB "
+                f"({(stats['rss'] - stats['rss_before']) / mb:+.0f} MB), "
+                f"peak {stats['peak_rss'] / mb:.0f} MB, "
+                f"python allocations peak {stats['python_peak'] / mb:.1f} MB"
+            )
+            if "cuda_peak" in stats:
+                description += (
+                    f", cuda peak {stats['cuda_peak'] / mb:.0f} MB "
+                    f"(reserved {stats['cuda_reserved'] / mb:.0f} MB)"
+                )
+            return description
+
+        print(f"initialize: {describe(initialize)}")
+        for i, stats in enumerate(handle_stats):
+            print(f"handle {i + 1} / {len(handle_stats)}: {describe(stats)}")
+        model = getattr(getattr(handler, "_service", None), "model", None)
+        if isinstance(model, torch.nn.Module):
+            tensors = list(model.parameters()) + list(model.buffers())
+            num_bytes = sum(t.numel() * t.element_size() for t in tensors)
+            print(f"Parameters and buffers of the model: {num_bytes / mb:.0f} MB")
+
+        footprint = max(stats["peak_rss"] for stats in [initialize] + handle_stats)
+        # torchserve starts one worker per cpu of the container, threads.num_workers
+        # only changes how the threads are split between them
+        num_workers = CONTAINER_CPUS
+        total = num_workers * footprint
+        print(
+            f"Projected footprint: {footprint / mb:.0f} MB per worker, "
+            f"{total / mb:.0f} MB for {num_workers} workers. Memory shared "
+            "between workers (e.g. memory-mapped weights) is counted once per "
+            "worker."
+        )
+        if total > CONTAINER_MEMORY:
+            print(
+                f"Warning: {num_workers} workers would use more than the "
+                f"{CONTAINER_MEMORY // (1024 * mb)}GB of the container. Consider "
+                "sharing the weights between workers (see _load_model_weights)."
+            )
+        return {
+            "initialize": initialize,
+            "handle": handle_stats,
+            "footprint": footprint,
+        }
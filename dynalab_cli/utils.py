@@ -3,9 +3,12 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import importlib
 import json
 import os
 import re
+import resource
+import sys
 import webbrowser
 
 import requests
@@ -162,6 +165,108 @@ def default_filename(key):
     raise NotImplementedError
 
 
+def load_handler_module(handler_path):
+    """
+    Import the handler file as a new module, with the current directory
+    in sys.path like in the docker
+    """
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+    handler_spec = importlib.util.spec_from_file_location("handler", handler_path)
+    handler = importlib.util.module_from_spec(handler_spec)
+    handler_spec.loader.exec_module(handler)
+    return handler
+
+
+def _read_proc_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_rss():
+    """
+    Current resident memory of this process in bytes, or its peak where the
+    current value is not available
+    """
+    rss = _read_proc_status("VmRSS")
+    return rss if rss is not None else get_peak_rss()
+
+
+def get_peak_rss():
+    """
+    Peak resident memory of this process in bytes, since it started or since
+    the last reset_peak_rss
+    """
+    peak = _read_proc_status("VmHWM")
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak returned by get_peak_rss to the current resident memory.
+    Only supported on linux, returns whether the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+METRICS_PREFIX = "DYNALAB_METRICS "
+# metrics measured by the integrated test, which a performance budget can bound
+PERFORMANCE_METRICS = ("startup_s", "qps", "p50_ms", "p95_ms", "p99_ms", "error_rate")
+
+
+def print_metrics(metrics):
+    """
+    Print the performance metrics measured in the docker on one line of
+    stdout, from which the integrated test reads them with parse_metrics
+    """
+    metrics = {name: metrics[name] for name in PERFORMANCE_METRICS if name in metrics}
+    print(METRICS_PREFIX + json.dumps(metrics), flush=True)
+
+
+def parse_metrics(output):
+    metrics = dict()
+    for line in output.splitlines():
+        if line.startswith(METRICS_PREFIX):
+            metrics.update(json.loads(line[len(METRICS_PREFIX) :]))
+    return metrics
+
+
+def check_performance_budget(budget, metrics):
+    """
+    Return one message for each bound of budget (e.g. {"max_p95_ms": 200})
+    that the metrics exceed or that was not measured
+    """
+    violations = []
+    for name, limit in budget.items():
+        bound, _, metric = name.partition("_")
+        if metric not in metrics:
+            violations.append(f"{metric} was not measured")
+        elif bound == "max" and metrics[metric] > limit:
+            violations.append(
+                f"{metric} is {metrics[metric]:.2f}, above the budget of {limit}"
+            )
+        elif bound == "min" and metrics[metric] < limit:
+            violations.append(
+                f"{metric} is {metrics[metric]:.2f}, below the budget of {limit}"
+            )
+    return violations
+
+
 def check_model_name(name):
     pat = re.compile("^[a-z0-9-]+$")
     if not pat.match(name):
@@ -171,6 +276,20 @@ def check_model_name(name):
         )
 
 
+def get_model_names(root_dir="."):
+    """
+    Names of the models initialized in the project at root_dir
+    """
+    dynalab_dir = os.path.join(root_dir, ".dynalab")
+    if not os.path.isdir(dynalab_dir):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(dynalab_dir)
+        if os.path.exists(os.path.join(dynalab_dir, name, "setup_config.json"))
+    )
+
+
 class SetupConfigHandler:
     def __init__(self, name, root_dir="."):
         """
@@ -194,6 +313,12 @@ class SetupConfigHandler:
             "model_files",
             "exclude",
         }
+        self.optional_config_fields = {
+            "threads",
+            "quantization",
+            "compiled_model",
+            "performance_budget",
+        }
         self.submission_dir = ".dynalab_submissions"
 
     def config_exists(self):
@@ -231,7 +356,9 @@ class SetupConfigHandler:
                 excluded_files.add(f)
             config[key] = ",".join(excluded_files)
         for key in config.keys():
-            assert key in self.config_fields, f"Invalid config field {key}"
+            assert (
+                key in self.config_fields or key in self.optional_config_fields
+            ), f"Invalid config field {key}"
             assert key not in contained_fields, f"Repeated config field {key}"
             contained_fields.add(key)
             if key == "task":
@@ -273,6 +400,45 @@ class SetupConfigHandler:
                         f"Cannot install {key} without or with empty "
                         f"./{default_filename(key)}"
                     )
+            elif key == "threads":
+                assert isinstance(config[key], dict), f"{key} field must be a dict"
+                for name, value in config[key].items():
+                    assert name in (
+                        "num_workers",
+                        "intra_op",
+                        "inter_op",
+                    ), f"Invalid {key} field {name}"
+                    # bool is a subclass of int
+                    assert (
+                        isinstance(value, int)
+                        and not isinstance(value, bool)
+                        and value > 0
+                    ), f"{key} field {name} must be a positive integer"
+            elif key == "quantization":
+                assert config[key] in (
+                    None,
+                    "dynamic_int8",
+                ), f"{key.capitalize()} field must be null or dynamic_int8"
+            elif key == "compiled_model":
+                if config[key]:
+                    assert check_path(
+                        os.path.join(self.root_dir, config[key]),
+                        root_dir=self.root_dir,
+                        allow_empty=False,
+                    ), f"{config[key]} is empty or not a valid path"
+            elif key == "performance_budget":
+                assert isinstance(config[key], dict), f"{key} field must be a dict"
+                for name, value in config[key].items():
+                    bound, _, metric = name.partition("_")
+                    assert bound in ("max", "min") and metric in PERFORMANCE_METRICS, (
+                        f"Invalid {key} field {name}, expected max_ or min_ followed "
+                        f"by one of {', '.join(PERFORMANCE_METRICS)}"
+                    )
+                    assert (
+                        isinstance(value, (int, float))
+                        and not isinstance(value, bool)
+                        and value >= 0
+                    ), f"{key} field {name} must be a non negative number"
 
         for field in self.config_fields:
             assert field in contained_fields, f"Missing config field {key}"
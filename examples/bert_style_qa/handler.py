@@ -22,20 +22,28 @@ class Handler(BaseDynaHandler):
         self.tokenizer = AutoTokenizer.from_pretrained(".")
         self.model.to(torch.device(device_str))
         self.model.eval()
+        # batch long and short examples separately to limit padding
+        self.enable_length_bucketing(max_bucket_size=16)
+        self.warmup(num_iterations=3)
 
         self.initialized = True
 
-    def preprocess(self, data):
+    def preprocess(self, examples):
         """
-        Preprocess data into a format that the model can do inference on.
+        Preprocess a batch of examples into a format that the model can do
+        inference on.
         """
-        example = self._read_data(data)
-        context = example["context"]
-        question = example["question"]
-        input_encoding = self.tokenizer.encode_plus(
-            question, context, max_length=512, return_tensors="pt"
+        questions = [example["question"] for example in examples]
+        contexts = [example["context"] for example in examples]
+        input_encoding = self.tokenizer(
+            questions,
+            contexts,
+            max_length=512,
+            truncation=True,
+            padding=True,
+            return_tensors="pt",
         )
-        input_ids = input_encoding["input_ids"].tolist()[0]
+        input_ids = input_encoding["input_ids"].tolist()
 
         return (input_encoding, input_ids)
 
@@ -45,48 +53,49 @@ class Handler(BaseDynaHandler):
         """
         input_encoding, input_ids = input_data
         with torch.no_grad():
-            output = self.model(**input_encoding)
+            output = self.model(**input_encoding.to(self.model.device))
 
-            answer_start_probs = torch.nn.functional.softmax(output.start_logits)
-            answer_end_probs = torch.nn.functional.softmax(output.end_logits)
+            # padding tokens must not take part in the span selection
+            padding_mask = input_encoding["attention_mask"].to(self.model.device) == 0
+            start_logits = output.start_logits.masked_fill(padding_mask, -float("inf"))
+            end_logits = output.end_logits.masked_fill(padding_mask, -float("inf"))
+            answer_start_probs = torch.nn.functional.softmax(start_logits, dim=1)
+            answer_end_probs = torch.nn.functional.softmax(end_logits, dim=1)
 
             best_answer_start_prob, best_answer_start = torch.max(
                 answer_start_probs, dim=1
             )
             best_answer_end_prob, best_answer_end = torch.max(answer_end_probs, dim=1)
 
-            conf = float(best_answer_start_prob * best_answer_end_prob)
-            answer = self.tokenizer.convert_tokens_to_string(
-                self.tokenizer.convert_ids_to_tokens(
-                    input_ids[best_answer_start : best_answer_end + 1]
+            confs = (best_answer_start_prob * best_answer_end_prob).tolist()
+            inference_output = []
+            for i, conf in enumerate(confs):
+                start = int(best_answer_start[i])
+                end = int(best_answer_end[i])
+                answer = self.tokenizer.convert_tokens_to_string(
+                    self.tokenizer.convert_ids_to_tokens(input_ids[i][start : end + 1])
                 )
-            )
+                inference_output.append((answer, conf))
 
-        return (answer, conf)
+        return inference_output
 
-    def postprocess(self, inference_output, data):
+    def postprocess(self, inference_output, examples):
         """
-        Post process inference output into a response.
+        Post process inference output into one response per example.
         """
-        answer, conf = inference_output
-        response = dict()
-        example = self._read_data(data)
-        response["id"] = example["uid"]
-        response["answer"] = answer if answer != "[CLS]" else ""
-        response["conf"] = conf
-        self.taskIO.sign_response(response, example)
-        return [response]
+        responses = []
+        for (answer, conf), example in zip(inference_output, examples):
+            response = dict()
+            response["id"] = example["uid"]
+            response["answer"] = answer if answer != "[CLS]" else ""
+            response["conf"] = conf
+            self.taskIO.sign_response(response, example)
+            responses.append(response)
+        return responses
 
 
 _service = Handler()
 
 
 def handle(data, context):
-    if not _service.initialized:
-        _service.initialize(context)
-    if data is None:
-        return None
-    input_data = _service.preprocess(data)
-    output = _service.inference(input_data)
-    response = _service.postprocess(output, data)
-    return response
+    return _service.handle(data, context)
@@ -29,43 +29,43 @@ class Handler(BaseDynaHandler):
         )
         self.initialized = True
 
-    def preprocess(self, data):
+    def preprocess(self, examples):
         """
-        Preprocess data into a format that the model can do inference on.
+        Preprocess a batch of examples into a format that the model can do
+        inference on.
         """
-        example = self._read_data(data)
-        return {"context": example["context"], "question": example["question"]}
+        return [
+            {"context": example["context"], "question": example["question"]}
+            for example in examples
+        ]
 
     def inference(self, input_data):
         """
         Run model using the processed data.
         """
-        result = self.pipeline(input_data)
-        return result
+        results = self.pipeline(input_data)
+        # the pipeline unwraps its output when it is given a single example
+        if isinstance(results, dict):
+            results = [results]
+        return results
 
-    def postprocess(self, inference_output, data):
+    def postprocess(self, inference_output, examples):
         """
-        Post process inference output into a response.
+        Post process inference output into one response per example.
         """
-        answer, conf = inference_output
-        response = dict()
-        example = self._read_data(data)
-        response["id"] = example["uid"]
-        response["answer"] = answer
-        response["conf"] = conf
-        self.taskIO.sign_response(response, example)
-        return [response]
+        responses = []
+        for result, example in zip(inference_output, examples):
+            response = dict()
+            response["id"] = example["uid"]
+            response["answer"] = result["answer"]
+            response["conf"] = result["score"]
+            self.taskIO.sign_response(response, example)
+            responses.append(response)
+        return responses
 
 
 _service = Handler()
 
 
 def handle(data, context):
-    if not _service.initialized:
-        _service.initialize(context)
-    if data is None:
-        return None
-    input_data = _service.preprocess(data)
-    output = _service.inference(input_data)
-    response = _service.postprocess(output, data)
-    return response
+    return _service.handle(data, context)
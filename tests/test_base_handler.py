@@ -0,0 +1,62 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import tempfile
+import unittest
+
+from dynalab.handler.base_handler import BaseDynaHandler
+from dynalab.tasks.task_io import TaskIO
+from test_task_io import TASK_INFO
+
+
+class EchoHandler(BaseDynaHandler):
+    def __init__(self, task_io):
+        super().__init__()
+        self.taskIO = task_io
+        self.num_examples = 0
+
+    def preprocess(self, examples):
+        self.num_examples += len(examples)
+        return examples
+
+    def inference(self, examples):
+        return examples
+
+    def postprocess(self, examples, data):
+        responses = []
+        for example in examples:
+            response = {"id": example["uid"], "label": "neutral"}
+            self.taskIO.sign_response(response, example)
+            responses.append(response)
+        return responses
+
+
+class BaseDynaHandlerUnitTest(unittest.TestCase):
+    def test_read_batch_keeps_unicode_line_separators(self):
+        examples = [{"uid": "1", "text": "a\u2028b\u2029c\x85d"}, {"uid": "2"}]
+        body = "\n".join(json.dumps(e, ensure_ascii=False) for e in examples)
+        handler = BaseDynaHandler()
+        read, layout = handler._read_batch([{"body": body}, {"body": examples[1]}])
+        self.assertEqual(read, examples + examples[1:])
+        self.assertEqual(layout, [2, None])
+
+    def test_response_cache_counts_repeated_examples_as_hits(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(TASK_INFO, f)
+        task_io = TaskIO("nli", task_info_path=f.name)
+        os.remove(f.name)
+        handler = EchoHandler(task_io)
+        handler.enable_response_cache()
+        example = next(task_io.generate_mock_data(1, seed=0))
+        examples = [dict(example, uid=str(i)) for i in range(3)]
+        responses = handler._run_examples(examples)
+        self.assertEqual([r["id"] for r in responses], ["0", "1", "2"])
+        for response, example in zip(responses, examples):
+            task_io.verify_response(response, example)
+        self.assertEqual(handler.num_examples, 1)
+        stats = handler.response_cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
@@ -0,0 +1,36 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+from dynalab.handler.bucketing import LengthBucketer
+
+
+class LengthBucketerUnitTest(unittest.TestCase):
+    def test_make_buckets(self):
+        bucketer = LengthBucketer(max_bucket_size=2)
+        buckets = bucketer.make_buckets([5, 1, 512, 3, 4])
+        self.assertEqual(buckets, [[1, 3], [4, 0], [2]])
+
+    def test_make_buckets_with_token_budget(self):
+        bucketer = LengthBucketer(max_bucket_size=8, max_bucket_tokens=10)
+        buckets = bucketer.make_buckets([2, 2, 2, 6, 2])
+        self.assertEqual(buckets, [[0, 1, 2, 4], [3]])
+
+    def test_run_restores_order(self):
+        bucketer = LengthBucketer(length_fn=len, max_bucket_size=2)
+        examples = ["ccc", "a", "bb", "dddd"]
+        seen_buckets = []
+
+        def run_bucket(bucket):
+            seen_buckets.append(bucket)
+            return [example.upper() for example in bucket]
+
+        outputs = bucketer.run(examples, run_bucket)
+        self.assertEqual(outputs, ["CCC", "A", "BB", "DDDD"])
+        self.assertEqual(seen_buckets, [["a", "bb"], ["ccc", "dddd"]])
+        stats = bucketer.get_stats()
+        self.assertEqual(stats["padded_tokens"], 12)
+        self.assertEqual(stats["real_tokens"], 10)
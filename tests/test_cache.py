@@ -0,0 +1,78 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from dynalab.handler.cache import ResponseCache
+from dynalab.tasks.task_io import TaskIO
+from test_task_io import TASK_INFO
+
+
+class ResponseCacheUnitTest(unittest.TestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(TASK_INFO, f)
+        self.task_io = TaskIO("nli", task_info_path=f.name)
+        os.remove(f.name)
+        self.examples = list(self.task_io.generate_mock_data(4, seed=0))
+        self.keys = [ResponseCache(self.task_io).make_key(e) for e in self.examples]
+
+    def make_response(self, example, label="neutral"):
+        response = {"id": example["uid"], "label": label}
+        self.task_io.sign_response(response, example)
+        return response
+
+    def test_hit_is_signed_for_the_new_example(self):
+        cache = ResponseCache(self.task_io)
+        self.assertIsNone(cache.get(self.keys[0], self.examples[0]))
+        cache.put(self.keys[0], self.make_response(self.examples[0]))
+        example = dict(self.examples[0], uid="other")
+        self.assertEqual(cache.make_key(example), self.keys[0])
+        response = cache.get(self.keys[0], example)
+        self.assertEqual(response["id"], "other")
+        self.task_io.verify_response(response, example)
+        self.assertEqual(cache.get_stats()["hits"], 1)
+        self.assertEqual(cache.get_stats()["misses"], 1)
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(self.task_io, max_size=2)
+        for key, example in zip(self.keys[:2], self.examples):
+            cache.put(key, self.make_response(example))
+        # the first entry becomes the most recently used
+        self.assertIsNotNone(cache.get(self.keys[0], self.examples[0]))
+        cache.put(self.keys[2], self.make_response(self.examples[2]))
+        self.assertIsNone(cache.get(self.keys[1], self.examples[1]))
+        self.assertIsNotNone(cache.get(self.keys[0], self.examples[0]))
+        self.assertIsNotNone(cache.get(self.keys[2], self.examples[2]))
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+    def test_ttl_expiry(self):
+        cache = ResponseCache(self.task_io, ttl=0.05)
+        cache.put(self.keys[0], self.make_response(self.examples[0]))
+        self.assertIsNotNone(cache.get(self.keys[0], self.examples[0]))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(self.keys[0], self.examples[0]))
+        stats = cache.get_stats()
+        self.assertEqual((stats["size"], stats["expirations"]), (0, 1))
+        self.assertEqual(stats["num_bytes"], 0)
+
+    def test_byte_limit(self):
+        response = self.make_response(self.examples[0])
+        num_bytes = len(json.dumps(ResponseCache.get_outputs(response)))
+        cache = ResponseCache(self.task_io, max_bytes=2 * num_bytes)
+        for key, example in zip(self.keys[:3], self.examples):
+            cache.put(key, self.make_response(example))
+        stats = cache.get_stats()
+        self.assertEqual((stats["size"], stats["evictions"]), (2, 1))
+        self.assertEqual(stats["num_bytes"], 2 * num_bytes)
+        self.assertIsNone(cache.get(self.keys[0], self.examples[0]))
+        # outputs larger than the whole cache are not cached
+        cache.put(self.keys[3], self.make_response(self.examples[3], "x" * 1000))
+        self.assertIsNone(cache.get(self.keys[3], self.examples[3]))
+        self.assertEqual(cache.get_stats()["size"], 2)
@@ -0,0 +1,80 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+import unittest
+
+from dynalab.handler.scheduler import MicroBatchScheduler
+
+
+class MicroBatchSchedulerUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def run_batch(self, examples):
+        self.started.set()
+        self.release.wait()
+        self.batches.append(list(examples))
+        return [example * 2 for example in examples]
+
+    def test_flush_on_size(self):
+        scheduler = MicroBatchScheduler(
+            self.run_batch, max_batch_size=2, max_wait_ms=10000
+        )
+        start = time.perf_counter()
+        self.assertEqual(scheduler.run([1, 2, 3, 4, 5]), [2, 4, 6, 8, 10])
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(self.batches, [[1, 2], [3, 4], [5]])
+        stats = scheduler.get_stats()
+        self.assertEqual(stats["num_batches"], 3)
+        self.assertEqual(stats["full_batch_ratio"], 2 / 3)
+
+    def test_flush_on_timeout(self):
+        scheduler = MicroBatchScheduler(
+            self.run_batch, max_batch_size=8, max_wait_ms=100
+        )
+        start = time.perf_counter()
+        future = scheduler.submit(1)
+        self.assertEqual(future.result(timeout=5), 2)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+        self.assertEqual(self.batches, [[1]])
+
+    def test_no_wait_once_the_whole_list_is_queued(self):
+        scheduler = MicroBatchScheduler(
+            self.run_batch, max_batch_size=8, max_wait_ms=10000
+        )
+        start = time.perf_counter()
+        self.assertEqual(scheduler.run([1, 2, 3]), [2, 4, 6])
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(self.batches, [[1, 2, 3]])
+
+    def test_concurrent_lists_share_a_batch(self):
+        # hold the first batch so that the next lists queue up behind it
+        self.release.clear()
+        scheduler = MicroBatchScheduler(
+            self.run_batch, max_batch_size=8, max_wait_ms=10000
+        )
+        results = dict()
+
+        def run(name, examples):
+            results[name] = scheduler.run(examples)
+
+        threads = [threading.Thread(target=run, args=("first", [1]))]
+        threads[0].start()
+        self.assertTrue(self.started.wait(timeout=5))
+        for name, examples, queued in (("second", [2, 3], 2), ("third", [4], 3)):
+            threads.append(threading.Thread(target=run, args=(name, examples)))
+            threads[-1].start()
+            while scheduler._queue.qsize() != queued:
+                time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        self.assertEqual(results, {"first": [2], "second": [4, 6], "third": [8]})
+        self.assertEqual(self.batches, [[1], [2, 3, 4]])
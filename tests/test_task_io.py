@@ -0,0 +1,165 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+
+from dynalab.tasks.task_io import TaskInfoCache, TaskIO
+
+
+TASK_INFO = {
+    "task": "nli",
+    "config": {
+        "context": [{"name": "context", "type": "string"}],
+        "input": [
+            {"name": "hypothesis", "type": "string"},
+            {
+                "name": "label",
+                "type": "multiclass",
+                "labels": ["entailed", "neutral", "contradictory"],
+            },
+        ],
+        "output": [
+            {"name": "label"},
+            {"name": "prob", "type": "prob", "reference_name": "label"},
+        ],
+    },
+}
+
+
+class TaskIOUnitTest(unittest.TestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(TASK_INFO, f)
+        self.task_io = TaskIO("nli", task_info_path=f.name)
+        os.remove(f.name)
+        self.data, _ = self.task_io.get_mock_data()
+        self.responses = [
+            {
+                "id": datum["uid"],
+                "label": "neutral",
+                "prob": {"entailed": 0.2, "neutral": 0.5, "contradictory": 0.3},
+            }
+            for datum in self.data
+        ]
+
+    def test_signature_is_unchanged(self):
+        self.task_io.sign_responses(self.responses, self.data)
+        for response, datum in zip(self.responses, self.data):
+            h = hashlib.sha1()
+            h.update(os.environ.get("MY_SECRET", "").encode("utf-8"))
+            h.update(b"nli")
+            for key in ("context", "hypothesis"):
+                h.update(str(datum[key]).encode("utf-8"))
+            for key in ("label", "prob"):
+                h.update(str(response[key]).encode("utf-8"))
+            self.assertEqual(response["signature"], h.hexdigest())
+            self.assertEqual(
+                response["signature"],
+                self.task_io.generate_response_signature(response, datum),
+            )
+            self.task_io.verify_response(response, datum)
+
+    def test_verify_responses_collects_failures(self):
+        self.responses[0]["label"] = "unknown"
+        self.task_io.sign_responses(self.responses, self.data)
+        self.responses[-1]["signature"] = "wrong"
+        failures = self.task_io.verify_responses(
+            self.responses, self.data, num_workers=1
+        )
+        self.assertEqual([i for i, _ in failures], [0, len(self.data) - 1])
+        self.assertIn("verify_multiclass", failures[0][1])
+
+    def test_verify_responses_pool(self):
+        data = self.data * 4
+        responses = [dict(response) for response in self.responses * 4]
+        responses[0]["label"] = "unknown"
+        for response, datum in zip(responses, data):
+            self.task_io.sign_response(response, datum)
+        responses[-2]["signature"] = "wrong"
+        # chunks of 2 responses verified by 2 processes
+        failures = self.task_io.verify_responses(
+            responses, data, num_workers=2, chunk_size=2
+        )
+        self.assertEqual([i for i, _ in failures], [0, len(data) - 2])
+        self.assertIn("verify_multiclass", failures[0][1])
+
+    def test_generate_mock_data_annotation_options(self):
+        options = {
+            "string_length": lambda rng: 3,
+            "annotation_options": {"context": {"string_length": lambda rng: 100}},
+        }
+        data = list(self.task_io.generate_mock_data(5, seed=1, options=options))
+        self.assertEqual(data, list(self.task_io.generate_mock_data(5, 1, options)))
+        for datum in data:
+            self.assertEqual(len(datum["context"].split(" ")), 100)
+            self.assertEqual(len(datum["hypothesis"].split(" ")), 3)
+
+    def test_generate_mock_data_is_unchanged_by_get_mock_data(self):
+        data = list(self.task_io.generate_mock_data(20, seed=0))
+        self.task_io.get_mock_data()
+        self.assertEqual(data, list(self.task_io.generate_mock_data(20, seed=0)))
+        self.assertEqual(
+            self.task_io.task_info["config"]["input"][1]["labels"],
+            ["entailed", "neutral", "contradictory"],
+        )
+
+    def test_task_io_do_not_share_their_config(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(TASK_INFO, f)
+        try:
+            first = TaskIO("nli", task_info_path=f.name)
+            first.task_info["config"]["input"][1]["labels"].append("other")
+            first.inputs_without_targets.clear()
+            second = TaskIO("nli", task_info_path=f.name)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(second.task_info, TASK_INFO)
+        self.assertEqual(
+            [annotation["name"] for annotation in second.inputs_without_targets],
+            ["hypothesis"],
+        )
+
+
+class TaskInfoCacheUnitTest(unittest.TestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(TASK_INFO, f)
+        self.path = f.name
+        self.cache = TaskInfoCache()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_hit(self):
+        entry = self.cache.get(self.path)
+        self.assertEqual(entry["task_info"], TASK_INFO)
+        self.assertIs(self.cache.get(self.path), entry)
+        self.assertIsNone(self.cache.get(self.path + ".missing"))
+        self.assertEqual(
+            self.cache.get_stats(), {"size": 1, "hits": 1, "loads": 1, "reloads": 0}
+        )
+
+    def test_reload_on_change(self):
+        entry = self.cache.get(self.path)
+        task_info = dict(TASK_INFO, task="other")
+        with open(self.path, "w") as f:
+            json.dump(task_info, f)
+        # the size changes, and so does the modification time
+        os.utime(self.path, ns=(0, entry["version"][0] + 1))
+        self.assertEqual(self.cache.get(self.path)["task_info"], task_info)
+        # same size, newer modification time
+        with open(self.path, "w") as f:
+            json.dump(dict(TASK_INFO, task="other"[::-1]), f)
+        os.utime(self.path, ns=(0, entry["version"][0] + 2))
+        self.assertEqual(self.cache.get(self.path)["task_info"]["task"], "rehto")
+        self.assertEqual(
+            self.cache.get_stats(), {"size": 1, "hits": 0, "loads": 1, "reloads": 2}
+        )
+        self.cache.clear()
+        self.assertEqual(self.cache.get_stats()["size"], 0)
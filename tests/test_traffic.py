@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import time
+import unittest
+
+from dynalab.handler.traffic import TrafficRecorder, decode_body, read_traffic, replay
+
+
+class TrafficUnitTest(unittest.TestCase):
+    def test_record_rotate_and_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorders = [
+                TrafficRecorder(
+                    os.path.join(directory, f"traffic-{i}.jsonl.gz"),
+                    max_bytes=256,
+                    backup_count=100,
+                    flush_every=8,
+                )
+                for i in range(2)
+            ]
+            for i in range(200):
+                body = {"uid": str(i)} if i % 2 else bytearray(b'{"uid": "a"}')
+                recorders[i % 2].record(body, arrival_time=float(i))
+            for recorder in recorders:
+                recorder.close()
+            self.assertGreater(len(os.listdir(directory)), 2)
+
+            records = list(read_traffic([directory]))
+            self.assertEqual([r["time"] for r in records], list(range(200)))
+            self.assertEqual(decode_body(records[0]), b'{"uid": "a"}')
+            self.assertEqual(decode_body(records[1]), {"uid": "1"})
+
+    def test_replay_max_speed(self):
+        records = [{"time": float(i), "body": {"uid": str(i)}} for i in range(20)]
+        sent = []
+        stats = replay(records, sent.append, speed=None, concurrency=4)
+        self.assertEqual(stats["num_requests"], 20)
+        self.assertEqual(stats["num_errors"], 0)
+        self.assertEqual(
+            sorted(body["uid"] for body in sent), sorted(str(i) for i in range(20))
+        )
+
+    def test_replay_latency_from_schedule(self):
+        # all the requests arrive at once but are sent one at a time, so each
+        # waits for the previous ones
+        records = [{"time": 0.0, "body": {"uid": str(i)}} for i in range(5)]
+        stats = replay(records, lambda body: time.sleep(0.05), speed=1.0)
+        self.assertEqual(stats["num_requests"], 5)
+        self.assertGreaterEqual(stats["p50_ms"], 100)